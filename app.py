@@ -1,12 +1,16 @@
-import copy
-import json
+import math
+import asyncio
+import hashlib
+import hmac
 import os
 import logging
 import uuid
 import httpx
+import importlib.util
 from quart import (
     Blueprint,
     Quart,
+    current_app,
     jsonify,
     make_response,
     request,
@@ -21,17 +25,53 @@ from azure.identity.aio import (
 )
 from backend.auth.auth_utils import get_authenticated_user_details
 from backend.security.ms_defender_utils import get_msdefender_user_json
-from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosdb_service import CosmosConversationClient
+from backend.history.conversation_list_cache import ConversationListCache
+from backend.stream_replay import StreamReplayBuffer
+from backend.semantic_cache import SemanticCache
+from backend.openai_pool import OpenAIBackend, OpenAIBackendPool
+from backend.rate_governor import TokenRateGovernor
+from backend.request_scheduler import FairRequestScheduler
+from backend.metrics import (
+    StageMetrics,
+    current_timings,
+    render_stats,
+    format_labels,
+    span,
+    start_request_timings,
+    timed,
+)
 from backend.settings import (
     app_settings,
     MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION
 )
 from backend.utils import (
+    user_groups_fetcher,
+    ConcurrencyLimiter,
+    LRUCache,
+    build_title_input,
+    get_token_encoding,
+    message_text,
+    estimate_request_tokens,
+    record_stream,
+    time_stream,
+    replay_stream,
+    response_cache_key,
+    truncate_to_tokens,
+    window_messages,
+    log_debug_payload,
+    close_stream,
     format_as_ndjson,
-    format_stream_response,
+    format_stream_chunk_message,
+    StreamResponseEncoder,
+    coalesce_stream,
+    format_as_sse,
+    parse_last_event_id,
     format_non_streaming_response,
     convert_to_pf_format,
     format_pf_non_streaming_response,
+    format_pf_stream_response,
+    parse_sse_data,
 )
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
@@ -41,6 +81,124 @@ def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
+
+    @app.before_serving
+    async def init():
+        # Long-lived clients shared by every request served by this worker
+        app.azure_credential = DefaultAzureCredential()
+        try:
+            app.azure_openai_client = init_openai_client(app.azure_credential)
+            app.openai_pool = init_openai_pool(app.azure_credential, app.azure_openai_client)
+        except Exception:
+            # Prompt Flow deployments can run without Azure OpenAI settings;
+            # requests that need the client fail with the configuration error
+            logging.exception("Failed to initialize Azure OpenAI client")
+            app.azure_openai_client = None
+            app.openai_pool = None
+        app.request_scheduler = None
+        if app_settings.base_settings.max_concurrent_requests > 0:
+            app.request_scheduler = FairRequestScheduler(
+                app_settings.base_settings.max_concurrent_requests,
+                app_settings.base_settings.user_max_concurrent_requests,
+                queue_timeout=app_settings.base_settings.request_queue_timeout,
+                user_weights=app_settings.base_settings.user_request_weights
+            )
+        app.rate_governor = None
+        if app_settings.azure_openai.tokens_per_minute > 0:
+            app.rate_governor = TokenRateGovernor(
+                app_settings.azure_openai.tokens_per_minute,
+                max_wait=app_settings.azure_openai.rate_limit_max_wait
+            )
+        app.promptflow_client = None
+        app.promptflow_limiter = None
+        if app_settings.base_settings.use_promptflow:
+            app.promptflow_client = init_promptflow_client()
+            app.promptflow_limiter = ConcurrencyLimiter(
+                app_settings.promptflow.max_concurrency
+            )
+        # Loading the tokenizer downloads its BPE file unless the image has it
+        # cached; keep that off the event loop and do not let it stall startup
+        try:
+            await asyncio.wait_for(asyncio.to_thread(get_token_encoding), TOKENIZER_LOAD_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("Tokenizer is still loading; estimating token counts until it is ready")
+        app.title_cache = LRUCache(app_settings.azure_openai.title_cache_size)
+        app.history_summary_cache = LRUCache()
+        app.response_cache = None
+        if app_settings.azure_openai.response_cache_size > 0:
+            app.response_cache = LRUCache(
+                app_settings.azure_openai.response_cache_size,
+                ttl=app_settings.azure_openai.response_cache_ttl
+            )
+        app.semantic_cache = None
+        app.embedding_http_client = None
+        app.embedding_token_provider = None
+        if app_settings.azure_openai.semantic_cache_size > 0:
+            if (
+                (app_settings.azure_openai.embedding_name and app.azure_openai_client) or
+                app_settings.azure_openai.embedding_endpoint
+            ):
+                app.semantic_cache = SemanticCache(
+                    app_settings.azure_openai.semantic_cache_size,
+                    threshold=app_settings.azure_openai.semantic_cache_threshold,
+                    ttl=app_settings.azure_openai.semantic_cache_ttl
+                )
+                app.embedding_http_client = httpx.AsyncClient(timeout=10.0)
+                if not app_settings.azure_openai.embedding_name and not app_settings.azure_openai.embedding_key:
+                    app.embedding_token_provider = get_bearer_token_provider(
+                        app.azure_credential,
+                        "https://cognitiveservices.azure.com/.default"
+                    )
+            else:
+                logging.warning("Semantic cache disabled: no embedding deployment or endpoint is configured")
+        app.stream_stats = {"completed": 0, "cancelled": 0}
+        app.stage_metrics = None
+        if app_settings.base_settings.metrics_enabled or app_settings.base_settings.server_timing_enabled:
+            app.stage_metrics = StageMetrics()
+        if app_settings.base_settings.metrics_enabled and not app_settings.base_settings.metrics_token:
+            logging.warning("/metrics is disabled: METRICS_TOKEN is not set")
+        app.stream_replay_buffer = StreamReplayBuffer(
+            ttl=app_settings.base_settings.sse_replay_ttl
+        )
+        if getattr(app_settings.datasource, "permitted_groups_column", None):
+            user_groups_fetcher.start(ttl=app_settings.datasource.permitted_groups_cache_ttl)
+        if app_settings.datasource:
+            # Build the static part of the datasource payload before the first request
+            app_settings.datasource.construct_payload_configuration()
+        try:
+            app.cosmos_conversation_client = init_cosmosdb_client(app.azure_credential)
+        except Exception:
+            logging.exception("Failed to initialize CosmosDB client")
+            app.cosmos_conversation_client = None
+
+    @app.after_serving
+    async def shutdown():
+        if app_settings.azure_openai.backends and app.openai_pool:
+            await app.openai_pool.close()
+        if app.azure_openai_client:
+            await app.azure_openai_client.close()
+        if app.promptflow_client:
+            await app.promptflow_client.aclose()
+        if app.embedding_http_client:
+            await app.embedding_http_client.aclose()
+        if app.cosmos_conversation_client:
+            await app.cosmos_conversation_client.close()
+        await app.azure_credential.close()
+        await user_groups_fetcher.close()
+
+    @app.before_request
+    async def start_timings():
+        if app.stage_metrics:
+            start_request_timings(app.stage_metrics)
+
+    @app.after_request
+    async def add_server_timing(response):
+        timings = current_timings()
+        if timings and app_settings.base_settings.server_timing_enabled:
+            # Streamed responses only report the stages finished before the first byte
+            response.headers["Server-Timing"] = timings.server_timing()
+        return response
+
     return app
 
 
@@ -70,6 +228,12 @@ if DEBUG.lower() == "true":
 
 USER_AGENT = "GitHubSampleWebApp/AsyncAzureOpenAI/1.0.0"
 
+# Characters of the user's message shown as the title until one is generated
+PLACEHOLDER_TITLE_LENGTH = 50
+
+# Seconds startup waits for the tokenizer; see TIKTOKEN_CACHE_DIR in WebApp.Dockerfile
+TOKENIZER_LOAD_TIMEOUT = 10
+
 
 # Frontend Settings via Environment Variables
 frontend_settings = {
@@ -88,6 +252,10 @@ frontend_settings = {
         "show_chat_history_button": app_settings.ui.show_chat_history_button,
     },
     "sanitize_answer": app_settings.base_settings.sanitize_answer,
+    "server_side_context": bool(
+        app_settings.chat_history and
+        app_settings.chat_history.server_side_context
+    ),
 }
 
 
@@ -95,13 +263,171 @@ frontend_settings = {
 MS_DEFENDER_ENABLED = os.environ.get("MS_DEFENDER_ENABLED", "true").lower() == "true"
 
 
+# Initialize Azure OpenAI Client
+def init_openai_client(credential=None, backend=None, max_retries=None):
+    azure_openai_client = None
+    try:
+        # API version check
+        if (
+            app_settings.azure_openai.preview_api_version
+            < MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION
+        ):
+            raise ValueError(
+                f"The minimum supported Azure OpenAI preview API version is '{MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION}'"
+            )
+
+        # Endpoint
+        if (
+            not app_settings.azure_openai.endpoint and
+            not app_settings.azure_openai.resource
+        ):
+            raise ValueError(
+                "AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE is required"
+            )
+
+        endpoint = (
+            app_settings.azure_openai.endpoint
+            if app_settings.azure_openai.endpoint
+            else f"https://{app_settings.azure_openai.resource}.openai.azure.com/"
+        )
+        if backend:
+            endpoint = backend.endpoint
+
+        # Authentication
+        aoai_api_key = backend.key if backend else app_settings.azure_openai.key
+        ad_token_provider = None
+        if not aoai_api_key:
+            logging.debug("No AZURE_OPENAI_KEY found, using Azure Entra ID auth")
+            ad_token_provider = get_bearer_token_provider(
+                credential or DefaultAzureCredential(),
+                "https://cognitiveservices.azure.com/.default"
+            )
+
+        # Deployment
+        deployment = backend.model if backend else app_settings.azure_openai.model
+        if not deployment:
+            raise ValueError("AZURE_OPENAI_MODEL is required")
+
+        # Default Headers
+        default_headers = {"x-ms-useragent": USER_AGENT}
+
+        # Pooled connections, kept alive across requests
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=app_settings.azure_openai.max_connections,
+                max_keepalive_connections=app_settings.azure_openai.max_keepalive_connections,
+                keepalive_expiry=app_settings.azure_openai.keepalive_expiry,
+            )
+        )
+
+        azure_openai_client = AsyncAzureOpenAI(
+            api_version=app_settings.azure_openai.preview_api_version,
+            api_key=aoai_api_key,
+            azure_ad_token_provider=ad_token_provider,
+            default_headers=default_headers,
+            azure_endpoint=endpoint,
+            http_client=http_client,
+        )
+        if max_retries is not None:
+            azure_openai_client = azure_openai_client.with_options(max_retries=max_retries)
+
+        return azure_openai_client
+    except Exception as e:
+        logging.exception("Exception in Azure OpenAI initialization", e)
+        azure_openai_client = None
+        raise e
+
+
+def init_openai_pool(credential=None, primary_client=None):
+    if not app_settings.azure_openai.backends:
+        return OpenAIBackendPool([
+            OpenAIBackend(primary_client, app_settings.azure_openai.model)
+        ])
+
+    # Fail over to another deployment instead of retrying a throttled one
+    return OpenAIBackendPool([
+        OpenAIBackend(
+            init_openai_client(credential, backend, max_retries=0),
+            backend.model,
+            weight=backend.weight,
+            # Exported as a metrics label, so never the endpoint URL
+            name=backend.name or f"backend-{index}"
+        )
+        for index, backend in enumerate(app_settings.azure_openai.backends)
+    ])
+
 
+def get_openai_pool():
+    if current_app.openai_pool is None:
+        raise ValueError("Azure OpenAI is not configured or failed to initialize")
+    return current_app.openai_pool
 
 
+def init_promptflow_client():
+    # HTTP/2 needs the optional h2 package (httpx[http2])
+    http2 = (
+        app_settings.promptflow.http2 and
+        importlib.util.find_spec("h2") is not None
+    )
+    return httpx.AsyncClient(
+        http2=http2,
+        # Adding timeout for scenarios where response takes longer to come back
+        timeout=float(app_settings.promptflow.response_timeout),
+        limits=httpx.Limits(
+            max_connections=app_settings.promptflow.max_connections,
+            max_keepalive_connections=app_settings.promptflow.max_keepalive_connections,
+        ),
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {app_settings.promptflow.api_key}",
+        },
+    )
 
 
+def init_cosmosdb_client(credential=None):
+    cosmos_conversation_client = None
+    if app_settings.chat_history:
+        try:
+            cosmos_endpoint = (
+                f"https://{app_settings.chat_history.account}.documents.azure.com:443/"
+            )
 
-def prepare_model_args(request_body, request_headers):
+            if not app_settings.chat_history.account_key:
+                credential = credential or DefaultAzureCredential()
+            else:
+                credential = app_settings.chat_history.account_key
+
+            conversation_list_cache = None
+            if app_settings.chat_history.list_cache_size > 0:
+                conversation_list_cache = ConversationListCache(
+                    max_users=app_settings.chat_history.list_cache_size,
+                    ttl=app_settings.chat_history.list_cache_ttl,
+                )
+
+            cosmos_conversation_client = CosmosConversationClient(
+                cosmosdb_endpoint=cosmos_endpoint,
+                credential=credential,
+                database_name=app_settings.chat_history.database,
+                container_name=app_settings.chat_history.conversations_container,
+                enable_message_feedback=app_settings.chat_history.enable_feedback,
+                bulk_delete_concurrency=app_settings.chat_history.bulk_delete_concurrency,
+                conversation_list_cache=conversation_list_cache,
+                message_cache=LRUCache(
+                    app_settings.chat_history.message_cache_size,
+                    ttl=app_settings.chat_history.message_cache_ttl,
+                ),
+            )
+        except Exception as e:
+            logging.exception("Exception in CosmosDB initialization", e)
+            cosmos_conversation_client = None
+            raise e
+    else:
+        logging.debug("CosmosDB not configured")
+
+    return cosmos_conversation_client
+
+
+async def prepare_model_args(request_body, request_headers):
     request_messages = request_body.get("messages", [])
     messages = []
     if not app_settings.datasource:
@@ -121,6 +447,8 @@ def prepare_model_args(request_body, request_headers):
                 }
             )
 
+    messages = await window_conversation_history(messages)
+
     user_json = None
     if (MS_DEFENDER_ENABLED):
         authenticated_user_details = get_authenticated_user_details(request_headers)
@@ -139,78 +467,116 @@ def prepare_model_args(request_body, request_headers):
     }
 
     if app_settings.datasource:
+        filter_string = await app_settings.datasource.construct_filter_string(request)
         model_args["extra_body"] = {
             "data_sources": [
                 app_settings.datasource.construct_payload_configuration(
-                    request=request
+                    filter=filter_string
                 )
             ]
         }
 
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = [
-            "key",
-            "connection_string",
-            "embedding_key",
-            "encoded_api_key",
-            "api_key",
-        ]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["data_sources"][0]["parameters"].get(
-                secret_param
-            ):
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    secret_param
-                ] = "*****"
-        authentication = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    "authentication"
-                ][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("embedding_dependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
-                if field in secret_params:
-                    model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                        "embedding_dependency"
-                    ]["authentication"][field] = "*****"
-
-    logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
+    log_debug_payload("REQUEST BODY", model_args)
 
     return model_args
 
 
-async def promptflow_request(request):
+async def window_conversation_history(messages):
+    max_tokens = app_settings.azure_openai.history_max_tokens
+    if max_tokens <= 0:
+        return messages
+
+    system, older, recent = window_messages(messages, max_tokens)
+    if not older:
+        return messages
+
+    if app_settings.azure_openai.history_summary:
+        # Leave room in the budget for the summary of the older turns
+        system, older, recent = window_messages(
+            messages, max_tokens - app_settings.azure_openai.history_summary_max_tokens
+        )
+        summary = await summarize_history(older)
+        if summary:
+            system = system + [{
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {summary}"
+            }]
+
+    logging.debug(f"Dropped {len(older)} older messages from the model input")
+    return system + recent
+
+
+async def summarize_history(older_messages):
+    summary_prompt = "Summarize the conversation so far in a few sentences. Keep names, facts and decisions the user may refer back to. Do not include any other commentary."
+
+    # Key i identifies older_messages[:i + 1], so the summary cached on an
+    # earlier turn is extended with the newly dropped messages only
+    digest = hashlib.sha256()
+    keys = []
+    for message in older_messages:
+        digest.update(f"{message['role']}\0{message_text(message)}\0".encode("utf-8"))
+        keys.append(digest.copy().hexdigest())
+
+    cache = current_app.history_summary_cache
+    summary = cache.get(keys[-1])
+    if summary:
+        return summary
+
+    previous_summary, start = None, 0
+    for index in range(len(keys) - 2, -1, -1):
+        previous_summary = cache.get(keys[index])
+        if previous_summary:
+            start = index + 1
+            break
+
+    messages = []
+    if previous_summary:
+        messages.append({
+            "role": "system",
+            "content": f"Summary of the earlier conversation: {previous_summary}"
+        })
+    for message in older_messages[start:]:
+        messages.append({
+            "role": message["role"],
+            "content": truncate_to_tokens(
+                message_text(message), app_settings.azure_openai.history_max_tokens
+            )
+        })
+    messages.append({"role": "user", "content": summary_prompt})
+
     try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {app_settings.promptflow.api_key}",
-        }
-        # Adding timeout for scenarios where response takes longer to come back
-        logging.debug(f"Setting timeout to {app_settings.promptflow.response_timeout}")
-        async with httpx.AsyncClient(
-            timeout=float(app_settings.promptflow.response_timeout)
-        ) as client:
-            pf_formatted_obj = convert_to_pf_format(
-                request,
-                app_settings.promptflow.request_field_name,
-                app_settings.promptflow.response_field_name
+        _, response = await get_openai_pool().call(
+            lambda backend: backend.client.chat.completions.create(
+                model=backend.model,
+                messages=messages,
+                temperature=0,
+                max_tokens=app_settings.azure_openai.history_summary_max_tokens
             )
-            # NOTE: This only support question and chat_history parameters
-            # If you need to add more parameters, you need to modify the request body
-            response = await client.post(
+        )
+        summary = response.choices[0].message.content
+        cache.set(keys[-1], summary)
+        return summary
+    except Exception:
+        logging.exception("Exception while summarizing conversation history")
+        return previous_summary
+
+
+async def promptflow_request(request):
+    try:
+        pf_formatted_obj = convert_to_pf_format(
+            request,
+            app_settings.promptflow.request_field_name,
+            app_settings.promptflow.response_field_name
+        )
+        # NOTE: This only support question and chat_history parameters
+        # If you need to add more parameters, you need to modify the request body
+        async with current_app.promptflow_limiter:
+            response = await current_app.promptflow_client.post(
                 app_settings.promptflow.endpoint,
                 json={
                     app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
                     "chat_history": pf_formatted_obj[:-1],
                 },
-                headers=headers,
             )
         resp = response.json()
         resp["id"] = request["messages"][-1]["id"]
@@ -219,7 +585,55 @@ async def promptflow_request(request):
         logging.error(f"An error occurred while making promptflow_request: {e}")
 
 
-async def send_chat_request(request_body, request_headers):
+async def promptflow_stream_request(request, client, limiter):
+    pf_formatted_obj = convert_to_pf_format(
+        request,
+        app_settings.promptflow.request_field_name,
+        app_settings.promptflow.response_field_name
+    )
+    async with limiter:
+        async with client.stream(
+            "POST",
+            app_settings.promptflow.endpoint,
+            json={
+                app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
+                "chat_history": pf_formatted_obj[:-1],
+            },
+            headers={"Accept": "text/event-stream"},
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(
+                    f"Promptflow endpoint returned {response.status_code}: {response.text}"
+                )
+
+            if response.headers.get("content-type", "").startswith("text/event-stream"):
+                async for pfChunk in parse_sse_data(response.aiter_lines()):
+                    yield pfChunk
+            else:
+                # Endpoints whose flow output is not a generator answer in one piece
+                await response.aread()
+                yield response.json()
+
+
+async def admit_chat_request(request_headers, messages):
+    """
+    Take the estimated tokens of a chat request from the rate governor ahead
+    of send_chat_request. Returns the admitted estimate, or None when requests
+    are not governed.
+    """
+    if not current_app.rate_governor or app_settings.base_settings.use_promptflow:
+        return None
+    cost = estimate_request_tokens({
+        "messages": messages,
+        "max_tokens": app_settings.azure_openai.max_tokens
+    })
+    authenticated_user = get_authenticated_user_details(request_headers)
+    await current_app.rate_governor.acquire(authenticated_user["user_principal_id"], cost)
+    return cost
+
+
+async def send_chat_request(request_body, request_headers, admitted_tokens=None):
     filtered_messages = []
     messages = request_body.get("messages", [])
     for message in messages:
@@ -227,21 +641,118 @@ async def send_chat_request(request_body, request_headers):
             filtered_messages.append(message)
             
     request_body['messages'] = filtered_messages
-    model_args = prepare_model_args(request_body, request_headers)
+    with span("prepare_model_args"):
+        model_args = await prepare_model_args(request_body, request_headers)
+
+    response_cache = current_app.response_cache
+    semantic_cache = current_app.semantic_cache
+    cacheable = (
+        model_args["temperature"] == 0 or
+        app_settings.azure_openai.response_cache_allow_sampling
+    )
+    cache_key = None
+    semantic_key = None
+    question_embedding = None
+    if cacheable and response_cache:
+        cache_key = response_cache_key(model_args)
+        cached = response_cache.get(cache_key)
+        if cached:
+            logging.debug("Serving answer from the response cache")
+            if admitted_tokens is not None:
+                current_app.rate_governor.release(admitted_tokens)
+            return replay_cached_response(cached, model_args["stream"])
+
+    # Paraphrases are only matched for the opening question of a conversation,
+    # since the answer to a later turn depends on the turns before it
+    system_messages = [m for m in model_args["messages"] if m["role"] == "system"]
+    if cacheable and semantic_cache and len(model_args["messages"]) == len(system_messages) + 1:
+        question_embedding = await embed_text(message_text(model_args["messages"][-1]))
+        if question_embedding:
+            # Partitioned by everything but the question, including the ACL filter
+            semantic_key = response_cache_key(dict(model_args, messages=system_messages))
+            # Scoring against every cached question is CPU-bound; keep it off the event loop
+            cached = await asyncio.to_thread(semantic_cache.get, semantic_key, question_embedding)
+            if cached:
+                logging.debug("Serving answer from the semantic cache")
+                if admitted_tokens is not None:
+                    current_app.rate_governor.release(admitted_tokens)
+                return replay_cached_response(cached, model_args["stream"])
+
+    if current_app.rate_governor and admitted_tokens is None:
+        authenticated_user = get_authenticated_user_details(request_headers)
+        await current_app.rate_governor.acquire(
+            authenticated_user["user_principal_id"], estimate_request_tokens(model_args)
+        )
 
     try:
-        azure_openai_client = init_openai_client()
-        raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
+        with span("upstream_response"):
+            backend, raw_response = await get_openai_pool().call(
+                lambda backend: backend.client.chat.completions.with_raw_response.create(
+                    **dict(model_args, model=backend.model)
+                )
+            )
         response = raw_response.parse()
         apim_request_id = raw_response.headers.get("apim-request-id") 
+        if model_args["stream"]:
+            response = backend.hold(response)
+            # Only upstream chunks are timed, never replays from the caches
+            timings = current_timings()
+            if timings:
+                response = time_stream(response, timings)
     except Exception as e:
         logging.exception("Exception in send_chat_request")
         raise e
 
+    def cache_response(cached):
+        if cache_key:
+            response_cache.set(cache_key, cached)
+        if semantic_key:
+            semantic_cache.set(semantic_key, question_embedding, cached)
+
+    if cache_key or semantic_key:
+        if model_args["stream"]:
+            response = record_stream(
+                response, lambda chunks: cache_response((chunks, apim_request_id))
+            )
+        else:
+            cache_response((response, apim_request_id))
+
+    return response, apim_request_id
+
+
+def replay_cached_response(cached, stream):
+    response, apim_request_id = cached
+    if stream:
+        return replay_stream(response), apim_request_id
     return response, apim_request_id
 
 
-async def complete_chat_request(request_body, request_headers):
+async def embed_text(text):
+    try:
+        if app_settings.azure_openai.embedding_name:
+            response = await current_app.azure_openai_client.embeddings.create(
+                model=app_settings.azure_openai.embedding_name, input=text
+            )
+            return response.data[0].embedding
+
+        if current_app.embedding_token_provider:
+            # Entra ID auth, as for the chat deployments when no key is configured
+            headers = {"Authorization": "Bearer " + await current_app.embedding_token_provider()}
+        else:
+            headers = {"api-key": app_settings.azure_openai.embedding_key}
+        response = await current_app.embedding_http_client.post(
+            app_settings.azure_openai.embedding_endpoint,
+            json={"input": text},
+            headers=headers
+        )
+        response.raise_for_status()
+        return response.json()["data"][0]["embedding"]
+    except Exception:
+        logging.exception("Exception while embedding the question")
+        return None
+
+
+async def complete_chat_request(request_body, request_headers, admitted_tokens=None):
     if app_settings.base_settings.use_promptflow:
         response = await promptflow_request(request_body)
         history_metadata = request_body.get("history_metadata", {})
@@ -252,51 +763,301 @@ async def complete_chat_request(request_body, request_headers):
             app_settings.promptflow.citations_field_name
         )
     else:
-        response, apim_request_id = await send_chat_request(request_body, request_headers)
+        response, apim_request_id = await send_chat_request(request_body, request_headers, admitted_tokens)
         history_metadata = request_body.get("history_metadata", {})
         return format_non_streaming_response(response, history_metadata, apim_request_id)
 
 
-async def stream_chat_request(request_body, request_headers):
-    response, apim_request_id = await send_chat_request(request_body, request_headers)
+async def stream_chat_request(request_body, request_headers, admitted_tokens=None):
+    if app_settings.base_settings.use_promptflow:
+        return stream_promptflow_chat_request(request_body)
+
+    response, apim_request_id = await send_chat_request(request_body, request_headers, admitted_tokens)
     history_metadata = request_body.get("history_metadata", {})
-    
+    # Resolved here because the generator runs after the request context is gone
+    app = current_app._get_current_object()
+    user_id = get_authenticated_user_details(request_headers)["user_principal_id"]
+    save_partial_answer = (
+        app_settings.chat_history is not None and
+        app_settings.chat_history.save_partial_answers and
+        history_metadata.get("conversation_id")
+    )
+
     async def generate():
-        async for completionChunk in response:
-            yield format_stream_response(completionChunk, history_metadata, apim_request_id)
+        encoder = StreamResponseEncoder(history_metadata, apim_request_id)
+        if app_settings.azure_openai.stream_coalesce_window_ms > 0:
+            messages = coalesce_stream(
+                response,
+                app_settings.azure_openai.stream_coalesce_window_ms,
+                app_settings.azure_openai.stream_coalesce_max_bytes
+            )
+        else:
+            messages = (
+                (completionChunk, format_stream_chunk_message(completionChunk))
+                async for completionChunk in response
+            )
+
+        tool_message = None
+        answer = []
+        try:
+            async for completionChunk, messageObj in messages:
+                if messageObj:
+                    if messageObj["role"] == "tool":
+                        tool_message = messageObj
+                    else:
+                        answer.append(messageObj["content"])
+                yield encoder.encode(completionChunk, messageObj)
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client went away: stop reading so the upstream completion
+            # is abandoned instead of generated to the end
+            app.stream_stats["cancelled"] += 1
+            if save_partial_answer and answer:
+                partial_messages = [tool_message] if tool_message else []
+                partial_messages.append({"role": "assistant", "content": "".join(answer)})
+                app.add_background_task(
+                    save_partial_messages, user_id, history_metadata["conversation_id"], partial_messages
+                )
+            raise
+        else:
+            app.stream_stats["completed"] += 1
+        finally:
+            await close_stream(messages)
+            await close_stream(response)
 
     return generate()
 
 
-async def conversation_internal(request_body, request_headers):
+async def save_partial_messages(user_id, conversation_id, messages):
+    await current_app.cosmos_conversation_client.create_messages(
+        conversation_id,
+        user_id,
+        [(str(uuid.uuid4()), message) for message in messages]
+    )
+
+
+def stream_promptflow_chat_request(request_body):
+    history_metadata = request_body.get("history_metadata", {})
+    message_uuid = request_body["messages"][-1]["id"]
+    # Resolved here because the generator runs outside the app context
+    client = current_app.promptflow_client
+    limiter = current_app.promptflow_limiter
+
+    async def generate():
+        async for pfChunk in promptflow_stream_request(request_body, client, limiter):
+            yield format_pf_stream_response(
+                pfChunk,
+                history_metadata,
+                app_settings.promptflow.response_field_name,
+                app_settings.promptflow.citations_field_name,
+                message_uuid
+            )
+
+    return generate()
+
+
+async def append_generated_title(stream, history_metadata, title_future):
     try:
-        if app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
-            result = await stream_chat_request(request_body, request_headers)
+        async for event in stream:
+            yield event
+    finally:
+        await close_stream(stream)
+    history_metadata["title"] = await title_future
+    yield {"history_metadata": history_metadata}
+
+
+async def acquire_request_slot(request_headers):
+    if not current_app.request_scheduler:
+        return None
+    authenticated_user = get_authenticated_user_details(request_headers)
+    return await current_app.request_scheduler.acquire(
+        authenticated_user["user_principal_id"]
+    )
+
+
+def load_shedding_response(ex):
+    # Answer fast and tell the client when to come back
+    logging.warning(str(ex))
+    response = jsonify({
+        "error": str(ex),
+        "queue_position": getattr(ex, "queue_position", None)
+    })
+    response.status_code = ex.status_code
+    response.headers["Retry-After"] = str(math.ceil(ex.retry_after))
+    return response
+
+
+async def conversation_internal(request_body, request_headers, title_future=None, slot=None, admitted_tokens=None):
+    """
+    Answer a chat request. A scheduler slot the caller already acquired is
+    passed in `slot` and released here; otherwise one is acquired first.
+    Likewise, `admitted_tokens` is the estimate the caller already took from
+    the rate governor, if any.
+    """
+    if app_settings.base_settings.use_promptflow:
+        use_stream = app_settings.promptflow.stream
+    else:
+        use_stream = app_settings.azure_openai.stream
+
+    authenticated_user = get_authenticated_user_details(request_headers)
+    try:
+        if slot is None:
+            slot = await acquire_request_slot(request_headers)
+
+        if use_stream:
+            result = await stream_chat_request(request_body, request_headers, admitted_tokens)
+            if title_future:
+                result = append_generated_title(
+                    result, request_body["history_metadata"], title_future
+                )
+            if slot:
+                # Released when the stream ends rather than when this returns
+                result = slot.hold(result)
+            if "text/event-stream" in request_headers.get("Accept", ""):
+                # The completion is buffered independently of this response so a
+                # dropped client can resume from /conversation/stream/<stream_id>
+                stream = current_app.stream_replay_buffer.start(
+                    format_as_ndjson(result), authenticated_user["user_principal_id"]
+                )
+                slot = None
+                return await make_sse_response(stream)
+            if slot:
+                # Quart does not close a body it never started sending, e.g. when
+                # the client went away first, but the task serving the request
+                # always ends, and the response is sent from it
+                slot.release_when_done(asyncio.current_task())
+                slot = None
             response = await make_response(format_as_ndjson(result))
             response.timeout = None
             response.mimetype = "application/json-lines"
             return response
         else:
-            result = await complete_chat_request(request_body, request_headers)
+            result = await complete_chat_request(request_body, request_headers, admitted_tokens)
+            if title_future:
+                # The response shares the history_metadata dict of the request
+                request_body["history_metadata"]["title"] = await title_future
             return jsonify(result)
 
     except Exception as ex:
+        if hasattr(ex, "retry_after"):
+            return load_shedding_response(ex)
         logging.exception(ex)
         if hasattr(ex, "status_code"):
             return jsonify({"error": str(ex)}), ex.status_code
         else:
             return jsonify({"error": str(ex)}), 500
+    finally:
+        if slot:
+            slot.release()
 
 
 @bp.route("/conversation", methods=["POST"])
 async def conversation():
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
-    request_json = await request.get_json()
+    with span("parse_json"):
+        request_json = await request.get_json()
+
+    conversation_id = request_json.get("conversation_id")
+    if conversation_id and request_json.get("server_side_context"):
+        cosmos_conversation_client = current_app.cosmos_conversation_client
+        if not cosmos_conversation_client:
+            return jsonify({"error": "CosmosDB is not configured or not working"}), 400
+        authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+        request_json["messages"] = await load_conversation_context(
+            cosmos_conversation_client,
+            authenticated_user["user_principal_id"],
+            conversation_id,
+            request_json.get("messages", [])
+        )
 
     return await conversation_internal(request_json, request.headers)
 
 
+async def load_conversation_context(cosmos_conversation_client, user_id, conversation_id, new_messages):
+    # The client sent only the new message(s); prepend the stored conversation
+    stored_messages = await cosmos_conversation_client.get_messages(user_id, conversation_id)
+    stored_messages.sort(key=lambda message: message.get("createdAt", ""))
+    return [
+        {
+            "id": message["id"],
+            "role": message["role"],
+            "content": message["content"]
+        }
+        for message in stored_messages
+    ] + new_messages
+
+
+async def make_sse_response(stream, last_event_index=-1):
+    response = await make_response(
+        format_as_sse(
+            stream,
+            last_event_index,
+            app_settings.base_settings.sse_heartbeat_interval
+        )
+    )
+    response.timeout = None
+    response.mimetype = "text/event-stream"
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers["X-Stream-Id"] = stream.id
+    return response
+
+
+@bp.route("/conversation/stream/<stream_id>", methods=["GET"])
+async def resume_conversation_stream(stream_id):
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    stream = current_app.stream_replay_buffer.get(stream_id)
+    if not stream or stream.owner_id != authenticated_user["user_principal_id"]:
+        return jsonify({"error": f"Stream {stream_id} was not found. It may have expired or been served by another instance."}), 404
+
+    last_event_index = parse_last_event_id(
+        request.headers.get("Last-Event-ID", request.args.get("last_event_id")), stream_id
+    )
+    return await make_sse_response(stream, last_event_index)
+
+
+@bp.route("/metrics", methods=["GET"])
+async def metrics():
+    if not app_settings.base_settings.metrics_enabled or not app_settings.base_settings.metrics_token:
+        return jsonify({"error": "Metrics are not enabled"}), 404
+
+    authorization = request.headers.get("Authorization", "")
+    expected = f"Bearer {app_settings.base_settings.metrics_token}"
+    if not hmac.compare_digest(authorization.encode(), expected.encode()):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # Every worker keeps its own counters and a scrape reaches one of them,
+    # so series carry the worker's pid and are aggregated by the scraper
+    worker = os.getpid()
+    lines = current_app.stage_metrics.render(worker=worker)
+    components = {
+        "title_cache": current_app.title_cache,
+        "history_summary_cache": current_app.history_summary_cache,
+        "response_cache": current_app.response_cache,
+        "semantic_cache": current_app.semantic_cache,
+        "promptflow_limiter": current_app.promptflow_limiter,
+        "rate_governor": current_app.rate_governor,
+        "request_scheduler": current_app.request_scheduler,
+    }
+    cosmos_conversation_client = current_app.cosmos_conversation_client
+    if cosmos_conversation_client:
+        components["conversation_list_cache"] = cosmos_conversation_client.conversation_list_cache
+        components["message_cache"] = cosmos_conversation_client.message_cache
+    for name, component in components.items():
+        if component:
+            lines.extend(render_stats(name, component.stats(), format_labels(worker=worker)))
+    lines.extend(render_stats("streams", current_app.stream_stats, format_labels(worker=worker)))
+    if current_app.openai_pool:
+        for backend_stats in current_app.openai_pool.stats():
+            lines.extend(render_stats(
+                "openai_backend", backend_stats, format_labels(backend=backend_stats["name"], worker=worker)
+            ))
+
+    response = await make_response("\n".join(lines) + "\n")
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+
 @bp.route("/frontend_settings", methods=["GET"])
 def get_frontend_settings():
     try:
@@ -313,19 +1074,35 @@ async def add_conversation():
     user_id = authenticated_user["user_principal_id"]
 
     ## check request for conversation_id
-    request_json = await request.get_json()
+    with span("parse_json"):
+        request_json = await request.get_json()
     conversation_id = request_json.get("conversation_id", None)
 
+    slot = None
+    admitted_tokens = None
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
+        # Admit the request before writing anything, so a busy answer does
+        # not leave a conversation without a reply behind
+        slot = await acquire_request_slot(request.headers)
+
+        if conversation_id and request_json.get("server_side_context"):
+            request_json["messages"] = await load_conversation_context(
+                cosmos_conversation_client, user_id, conversation_id, request_json["messages"]
+            )
+        admitted_tokens = await admit_chat_request(request.headers, request_json["messages"])
+
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
+        title_future = None
         if not conversation_id:
-            title = await generate_title(request_json["messages"])
+            # Start with the user's message as the title; the generated title
+            # is persisted and sent to the client once it is ready
+            title = placeholder_title(request_json["messages"])
             conversation_dict = await cosmos_conversation_client.create_conversation(
                 user_id=user_id, title=title
             )
@@ -333,6 +1110,15 @@ async def add_conversation():
             history_metadata["title"] = title
             history_metadata["date"] = conversation_dict["createdAt"]
 
+            title_future = asyncio.get_running_loop().create_future()
+            current_app.add_background_task(
+                update_conversation_title,
+                user_id,
+                conversation_id,
+                request_json["messages"],
+                title_future
+            )
+
         ## Format the incoming message object in the "chat/completions" messages format
         ## then write it to the conversation history in cosmos
         messages = request_json["messages"]
@@ -352,17 +1138,28 @@ async def add_conversation():
         else:
             raise Exception("No user message found")
 
-        await cosmos_conversation_client.cosmosdb_client.close()
 
         # Submit request to Chat Completions for response
-        request_body = await request.get_json()
+        request_body = request_json
         history_metadata["conversation_id"] = conversation_id
         request_body["history_metadata"] = history_metadata
-        return await conversation_internal(request_body, request.headers)
+        # conversation_internal releases the slot and spends the tokens from here on
+        slot, request_slot = None, slot
+        admitted_tokens, request_admitted_tokens = None, admitted_tokens
+        return await conversation_internal(
+            request_body, request.headers, title_future, request_slot, request_admitted_tokens
+        )
 
     except Exception as e:
+        if hasattr(e, "retry_after"):
+            return load_shedding_response(e)
         logging.exception("Exception in /history/generate")
         return jsonify({"error": str(e)}), 500
+    finally:
+        if slot:
+            slot.release()
+        if admitted_tokens is not None:
+            current_app.rate_governor.release(admitted_tokens)
 
 
 @bp.route("/history/update", methods=["POST"])
@@ -376,7 +1173,7 @@ async def update_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -388,26 +1185,26 @@ async def update_conversation():
         ## then write it to the conversation history in cosmos
         messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
+            input_messages = []
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 # write the tool message first
-                await cosmos_conversation_client.create_message(
-                    uuid=str(uuid.uuid4()),
-                    conversation_id=conversation_id,
-                    user_id=user_id,
-                    input_message=messages[-2],
-                )
+                input_messages.append((str(uuid.uuid4()), messages[-2]))
             # write the assistant message
-            await cosmos_conversation_client.create_message(
-                uuid=messages[-1]["id"],
+            input_messages.append((messages[-1]["id"], messages[-1]))
+            createdMessageValue = await cosmos_conversation_client.create_messages(
                 conversation_id=conversation_id,
                 user_id=user_id,
-                input_message=messages[-1],
+                input_messages=input_messages,
             )
+            if createdMessageValue == "Conversation not found":
+                raise Exception(
+                    "Conversation not found for the given conversation ID: "
+                    + conversation_id
+                    + "."
+                )
         else:
             raise Exception("No bot messages found")
 
-        # Submit request to Chat Completions for response
-        await cosmos_conversation_client.cosmosdb_client.close()
         response = {"success": True}
         return jsonify(response), 200
 
@@ -420,7 +1217,7 @@ async def update_conversation():
 async def update_message():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = current_app.cosmos_conversation_client
 
     ## check request for message_id
     request_json = await request.get_json()
@@ -477,21 +1274,15 @@ async def delete_conversation():
             return jsonify({"error": "conversation_id is required"}), 400
 
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        ## delete the conversation messages from cosmos first
-        deleted_messages = await cosmos_conversation_client.delete_messages(
-            conversation_id, user_id
-        )
-
-        ## Now delete the conversation
-        deleted_conversation = await cosmos_conversation_client.delete_conversation(
+        ## delete the conversation messages and then the conversation from cosmos
+        deleted_conversation = await cosmos_conversation_client.delete_conversation_and_messages(
             user_id, conversation_id
         )
 
-        await cosmos_conversation_client.cosmosdb_client.close()
 
         return (
             jsonify(
@@ -509,26 +1300,30 @@ async def delete_conversation():
 
 @bp.route("/history/list", methods=["GET"])
 async def list_conversations():
-    offset = request.args.get("offset", 0)
+    continuation_token = request.args.get("continuation_token", None)
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = current_app.cosmos_conversation_client
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
     ## get the conversations from cosmos
-    conversations = await cosmos_conversation_client.get_conversations(
-        user_id, offset=offset, limit=25
-    )
-    await cosmos_conversation_client.cosmosdb_client.close()
+    try:
+        conversations, continuation_token = await cosmos_conversation_client.get_conversations_page(
+            user_id, limit=25, continuation_token=continuation_token
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-    ## return the conversation ids
-
-    return jsonify(conversations), 200
+    ## return the conversation ids, along with the token for the next page if there is one
+    response = jsonify(conversations)
+    if continuation_token:
+        response.headers["X-Continuation-Token"] = continuation_token
+    return response, 200
 
 
 @bp.route("/history/read", methods=["POST"])
@@ -544,7 +1339,7 @@ async def get_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = current_app.cosmos_conversation_client
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
@@ -580,7 +1375,6 @@ async def get_conversation():
         for msg in conversation_messages
     ]
 
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
 
 
@@ -597,7 +1391,7 @@ async def rename_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = current_app.cosmos_conversation_client
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
@@ -624,7 +1418,6 @@ async def rename_conversation():
         conversation
     )
 
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify(updated_conversation), 200
 
 
@@ -633,32 +1426,27 @@ async def delete_all_conversations():
     ## get the user id from the request headers
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
+    background = request.args.get("background", "false").lower() == "true"
 
     # get conversations for user
     try:
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        conversations = await cosmos_conversation_client.get_conversations(
-            user_id, offset=0, limit=None
-        )
-        if not conversations:
-            return jsonify({"error": f"No conversations for {user_id} were found"}), 404
-
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = await cosmos_conversation_client.delete_messages(
-                conversation["id"], user_id
+        if background:
+            ## record a job and return its id right away; progress is polled via /history/delete_all/<job_id>
+            job = await cosmos_conversation_client.create_job(user_id, "delete_all")
+            current_app.add_background_task(
+                run_delete_all_job, cosmos_conversation_client, user_id, job["id"]
             )
+            return jsonify({"job_id": job["id"], "status": job["status"]}), 202
+
+        deleted_conversations = await cosmos_conversation_client.delete_all_conversations(user_id)
+        if not deleted_conversations:
+            return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-            ## Now delete the conversation
-            deleted_conversation = await cosmos_conversation_client.delete_conversation(
-                user_id, conversation["id"]
-            )
-        await cosmos_conversation_client.cosmosdb_client.close()
         return (
             jsonify(
                 {
@@ -673,6 +1461,47 @@ async def delete_all_conversations():
         return jsonify({"error": str(e)}), 500
 
 
+async def run_delete_all_job(cosmos_conversation_client, user_id, job_id):
+    try:
+        deleted_conversations = await cosmos_conversation_client.delete_all_conversations(user_id)
+        await cosmos_conversation_client.update_job(
+            user_id, job_id, "succeeded", deletedConversations=len(deleted_conversations)
+        )
+    except Exception as e:
+        logging.exception("Exception in delete_all background job")
+        await cosmos_conversation_client.update_job(user_id, job_id, "failed", error=str(e))
+
+
+@bp.route("/history/delete_all/<job_id>", methods=["GET"])
+async def get_delete_all_job(job_id):
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
+
+    ## make sure cosmos is configured
+    cosmos_conversation_client = current_app.cosmos_conversation_client
+    if not cosmos_conversation_client:
+        raise Exception("CosmosDB is not configured or not working")
+
+    job = await cosmos_conversation_client.get_job(user_id, job_id)
+    if not job:
+        return jsonify({"error": f"Job {job_id} was not found."}), 404
+    if job["status"] != "running":
+        ## the outcome has been reported; don't leave the record in the user's partition
+        await cosmos_conversation_client.delete_job(user_id, job_id)
+
+    return (
+        jsonify(
+            {
+                "job_id": job["id"],
+                "status": job["status"],
+                "deleted_conversations": job.get("deletedConversations"),
+                "error": job.get("error"),
+            }
+        ),
+        200,
+    )
+
+
 @bp.route("/history/clear", methods=["POST"])
 async def clear_messages():
     ## get the user id from the request headers
@@ -688,7 +1517,7 @@ async def clear_messages():
             return jsonify({"error": "conversation_id is required"}), 400
 
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -717,14 +1546,16 @@ async def ensure_cosmos():
         return jsonify({"error": "CosmosDB is not configured"}), 404
 
     try:
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = current_app.cosmos_conversation_client
+        if not cosmos_conversation_client:
+            return jsonify({"error": "CosmosDB is not configured or not working"}), 500
+
         success, err = await cosmos_conversation_client.ensure()
-        if not cosmos_conversation_client or not success:
+        if not success:
             if err:
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDB is not configured or not working"}), 500
 
-        await cosmos_conversation_client.cosmosdb_client.close()
         return jsonify({"message": "CosmosDB is configured and working"}), 200
     except Exception as e:
         logging.exception("Exception in /history/ensure")
@@ -753,27 +1584,54 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
+def placeholder_title(conversation_messages) -> str:
+    return message_text(conversation_messages[-1])[:PLACEHOLDER_TITLE_LENGTH]
+
+
+async def update_conversation_title(user_id, conversation_id, conversation_messages, title_future):
+    title = placeholder_title(conversation_messages)
+    try:
+        title = await generate_title(conversation_messages)
+    except Exception:
+        logging.exception("Exception while generating title")
+    finally:
+        # The streamed response waits on title_future, so it must always resolve
+        title_future.set_result(title)
+    await current_app.cosmos_conversation_client.update_conversation_title(
+        user_id, conversation_id, title
+    )
+
+
+@timed("title_generation")
 async def generate_title(conversation_messages) -> str:
-    ## make sure the messages are sorted by _ts descending
     title_prompt = "Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Do not include any other commentary or description."
 
+    title_input = build_title_input(
+        conversation_messages, app_settings.azure_openai.title_max_input_tokens
+    )
+    cache_key = hashlib.sha256(title_input.encode("utf-8")).hexdigest()
+    title = current_app.title_cache.get(cache_key)
+    if title:
+        return title
+
     messages = [
-        {"role": msg["role"], "content": msg["content"]}
-        for msg in conversation_messages
+        {"role": "user", "content": title_input},
+        {"role": "user", "content": title_prompt}
     ]
-    messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = init_openai_client()
-        response = await azure_openai_client.chat.completions.create(
-            model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
+        _, response = await get_openai_pool().call(
+            lambda backend: backend.client.chat.completions.create(
+                model=backend.model, messages=messages, temperature=1, max_tokens=64
+            )
         )
 
         title = response.choices[0].message.content
+        current_app.title_cache.set(cache_key, title)
         return title
     except Exception as e:
         logging.exception("Exception while generating title", e)
-        return messages[-2]["content"]
+        return placeholder_title(conversation_messages)
 
 
 app = create_app()
@@ -0,0 +1,53 @@
+from backend.utils import LRUCache
+
+
+class ConversationListCache():
+    """
+    LRU cache of the first pages of each user's conversation list, keyed by
+    user_principal_id. Writes invalidate the user's entry; the TTL bounds
+    staleness from writes served by other workers.
+    """
+
+    def __init__(self, max_users: int = 1000, max_pages: int = 4, ttl: float = 30.0):
+        self.max_pages = max_pages
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidation so a read that started before a write
+        # cannot store its stale result afterwards
+        self.generation = 0
+        self._users = LRUCache(max_users, ttl=ttl)
+
+    def get(self, user_id, continuation_token=None):
+        pages = self._users.get(user_id)
+        page = pages.get(continuation_token) if pages else None
+        if page is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return page
+
+    def set(self, user_id, continuation_token, conversations, next_continuation_token, generation):
+        if generation != self.generation:
+            return
+
+        pages = self._users.get(user_id)
+        if pages is None:
+            pages = {}
+            self._users.set(user_id, pages)
+        if len(pages) >= self.max_pages and continuation_token not in pages:
+            return
+
+        # Later pages share the entry, and its TTL, of the first one
+        pages[continuation_token] = (conversations, next_continuation_token)
+
+    def invalidate(self, user_id):
+        self.generation += 1
+        self._users.invalidate(user_id)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'users': self._users.stats()['entries']
+        }
@@ -1,16 +1,26 @@
 import uuid
+import base64
+import asyncio
 from datetime import datetime
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
+
+from backend.metrics import timed
+
+# Maximum number of operations Cosmos DB accepts in one transactional batch
+BATCH_OPERATION_LIMIT = 100
   
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, bulk_delete_concurrency: int = 4, conversation_list_cache = None, message_cache = None):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        self.bulk_delete_concurrency = bulk_delete_concurrency
+        self.conversation_list_cache = conversation_list_cache
+        self.message_cache = message_cache
         try:
             self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
         except exceptions.CosmosHttpResponseError as e:
@@ -45,6 +55,10 @@ class CosmosConversationClient():
             
         return True, "CosmosDB client initialized successfully"
 
+    async def close(self):
+        await self.cosmosdb_client.close()
+
+    @timed("cosmos_create_conversation")
     async def create_conversation(self, user_id, title = ''):
         conversation = {
             'id': str(uuid.uuid4()),  
@@ -56,39 +70,171 @@ class CosmosConversationClient():
         }
         ## TODO: add some error handling based on the output of the upsert_item call
         resp = await self.container_client.upsert_item(conversation)  
+        self._invalidate_conversation_list(user_id)
         if resp:
             return resp
         else:
             return False
     
+    @timed("cosmos_upsert_conversation")
     async def upsert_conversation(self, conversation):
         resp = await self.container_client.upsert_item(conversation)
+        self._invalidate_conversation_list(conversation['userId'])
         if resp:
             return resp
         else:
             return False
 
+    @timed("cosmos_update_conversation_title")
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        ## patch only the title so concurrent message writes are not overwritten
+        try:
+            resp = await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/title', 'value': title}]
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+        self._invalidate_conversation_list(user_id)
+        return resp
+
     async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
+        try:
             resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            resp = True
+        self._invalidate_conversation_list(user_id)
+        return resp
+
+    async def delete_messages(self, conversation_id, user_id):
+        ## get the ids of all the messages in the conversation
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = f"SELECT c.id FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId"
+        message_ids = []
+        async for item in self.container_client.query_items(query=query, parameters=parameters):
+            message_ids.append(item['id'])
+
+        try:
+            if message_ids:
+                return await self.delete_items(user_id, message_ids)
+        finally:
+            self._invalidate_messages(user_id, conversation_id)
+
+    async def delete_conversation_and_messages(self, user_id, conversation_id):
+        ## messages go first so a failure never leaves messages without their conversation
+        await self.delete_messages(conversation_id, user_id)
+        return await self.delete_conversation(user_id, conversation_id)
+
+    async def delete_all_conversations(self, user_id):
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = f"SELECT c.id, c.type FROM c WHERE c.userId = @userId AND (c.type='conversation' OR c.type='message')"
+        conversation_ids = []
+        message_ids = []
+        async for item in self.container_client.query_items(query=query, parameters=parameters):
+            if item['type'] == 'conversation':
+                conversation_ids.append(item['id'])
+            else:
+                message_ids.append(item['id'])
+
+        try:
+            await self.delete_items(user_id, message_ids)
+            await self.delete_items(user_id, conversation_ids)
+        finally:
+            for conversation_id in conversation_ids:
+                self._invalidate_messages(user_id, conversation_id)
+        return conversation_ids
+
+    async def delete_items(self, user_id, item_ids):
+        ## all of a user's items share the userId partition, so they can be deleted in
+        ## transactional batches, a bounded number of batches at a time
+        semaphore = asyncio.Semaphore(self.bulk_delete_concurrency)
+
+        async def delete_batch(batch_ids):
+            async with semaphore:
+                while batch_ids:
+                    try:
+                        await self.container_client.execute_item_batch(
+                            batch_operations=[('delete', (item_id,)) for item_id in batch_ids],
+                            partition_key=user_id
+                        )
+                        return
+                    except exceptions.CosmosBatchOperationError as e:
+                        ## an item deleted concurrently fails the whole batch; drop it and retry the rest
+                        failed_status = int(e.operation_responses[e.error_index].get('statusCode', 0))
+                        if failed_status != 404:
+                            raise
+                        batch_ids = batch_ids[:e.error_index] + batch_ids[e.error_index + 1:]
+
+        try:
+            await asyncio.gather(*[
+                delete_batch(item_ids[i:i + BATCH_OPERATION_LIMIT])
+                for i in range(0, len(item_ids), BATCH_OPERATION_LIMIT)
+            ])
+        finally:
+            self._invalidate_conversation_list(user_id)
+        return item_ids
+
+    async def create_job(self, user_id, job_type):
+        job = {
+            'id': str(uuid.uuid4()),
+            'type': 'job',
+            'jobType': job_type,
+            'status': 'running',
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'userId': user_id,
+            ## expire job records nobody polled after a day; needs defaultTtl set on the container
+            'ttl': 24 * 60 * 60
+        }
+        resp = await self.container_client.upsert_item(job)
+        if resp:
             return resp
         else:
-            return True
+            return False
 
-        
-    async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+    async def update_job(self, user_id, job_id, status, **fields):
+        patch_operations = [
+            {'op': 'set', 'path': '/status', 'value': status},
+            {'op': 'set', 'path': '/updatedAt', 'value': datetime.utcnow().isoformat()}
+        ]
+        for name, value in fields.items():
+            patch_operations.append({'op': 'set', 'path': f'/{name}', 'value': value})
+        return await self.container_client.patch_item(
+            item=job_id, partition_key=user_id, patch_operations=patch_operations
+        )
+
+    async def get_job(self, user_id, job_id):
+        try:
+            job = await self.container_client.read_item(item=job_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        if job.get('type') != 'job':
+            return None
+        return job
+
+    async def delete_job(self, user_id, job_id):
+        try:
+            await self.container_client.delete_item(item=job_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
 
 
-    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+    async def get_conversations_page(self, user_id, limit, sort_order = 'DESC', continuation_token = None):
         parameters = [
             {
                 'name': '@userId',
@@ -96,15 +242,63 @@ class CosmosConversationClient():
             }
         ]
         query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
-        if limit is not None:
-            query += f" offset {offset} limit {limit}" 
-        
+
+        generation = None
+        if self.conversation_list_cache and sort_order == 'DESC':
+            cached_page = self.conversation_list_cache.get(user_id, continuation_token)
+            if cached_page:
+                return cached_page
+            generation = self.conversation_list_cache.generation
+
+        ## resume from the Cosmos continuation so every page costs the same, unlike OFFSET
+        pager = self.container_client.query_items(
+            query=query, parameters=parameters, partition_key=user_id, max_item_count=limit
+        ).by_page(self._decode_continuation_token(continuation_token))
+
         conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
-        
-        return conversations
+        try:
+            async for page in pager:
+                async for item in page:
+                    conversations.append(item)
+                break
+        except exceptions.CosmosHttpResponseError as e:
+            # A token that decodes but that Cosmos rejects is still the caller's error
+            if continuation_token and e.status_code == 400:
+                raise ValueError("Invalid continuation token") from e
+            raise
+
+        next_continuation_token = self._encode_continuation_token(pager.continuation_token)
+        if generation is not None:
+            self.conversation_list_cache.set(
+                user_id, continuation_token, conversations, next_continuation_token, generation
+            )
+
+        return conversations, next_continuation_token
+
+    def _invalidate_conversation_list(self, user_id):
+        if self.conversation_list_cache:
+            self.conversation_list_cache.invalidate(user_id)
+
+    def _invalidate_messages(self, user_id, conversation_id):
+        if self.message_cache:
+            self.message_cache.invalidate((user_id, conversation_id))
 
+    @staticmethod
+    def _encode_continuation_token(continuation_token):
+        if not continuation_token:
+            return None
+        return base64.urlsafe_b64encode(continuation_token.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def _decode_continuation_token(continuation_token):
+        if not continuation_token:
+            return None
+        try:
+            return base64.urlsafe_b64decode(continuation_token.encode('ascii')).decode('utf-8')
+        except (ValueError, UnicodeError) as e:
+            raise ValueError("Invalid continuation token") from e
+
+    @timed("cosmos_get_conversation")
     async def get_conversation(self, user_id, conversation_id):
         parameters = [
             {
@@ -128,29 +322,58 @@ class CosmosConversationClient():
             return conversations[0]
  
     async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
-        message = {
-            'id': uuid,
-            'type': 'message',
-            'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
-            'conversationId' : conversation_id,
-            'role': input_message['role'],
-            'content': input_message['content']
-        }
+        resp = await self.create_messages(conversation_id, user_id, [(uuid, input_message)])
+        if resp and isinstance(resp, list):
+            return resp[0]
+        return resp
 
-        if self.enable_message_feedback:
-            message['feedback'] = ''
-        
-        resp = await self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
+    @timed("cosmos_create_messages")
+    async def create_messages(self, conversation_id, user_id, input_messages: list):
+        messages = []
+        for message_id, input_message in input_messages:
+            message = {
+                'id': message_id,
+                'type': 'message',
+                'userId' : user_id,
+                'createdAt': datetime.utcnow().isoformat(),
+                'updatedAt': datetime.utcnow().isoformat(),
+                'conversationId' : conversation_id,
+                'role': input_message['role'],
+                'content': input_message['content']
+            }
+
+            if self.enable_message_feedback:
+                message['feedback'] = ''
+
+            messages.append(message)
+
+        ## write the messages and bump the parent conversation's updatedAt field in one
+        ## transactional batch on the user's partition, so a turn costs a single round trip
+        batch_operations = [('upsert', (message,)) for message in messages]
+        batch_operations.append(
+            ('patch', (conversation_id, [
+                {'op': 'set', 'path': '/updatedAt', 'value': messages[-1]['createdAt']}
+            ]))
+        )
+        try:
+            resp = await self.container_client.execute_item_batch(
+                batch_operations=batch_operations, partition_key=user_id
+            )
+        except exceptions.CosmosBatchOperationError as e:
+            ## the patch is the last operation; it fails when the conversation does not exist
+            if e.error_index == len(messages):
                 return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
-            return resp
+            raise
+        self._invalidate_conversation_list(user_id)
+
+        if resp:
+            created_messages = [result.get('resourceBody') for result in resp[:len(messages)]]
+            if self.message_cache:
+                ## keep a cached copy of the conversation current instead of re-reading it
+                cached_messages = self.message_cache.get((user_id, conversation_id))
+                if cached_messages is not None:
+                    self.message_cache.set((user_id, conversation_id), cached_messages + created_messages)
+            return created_messages
         else:
             return False
     
@@ -159,11 +382,18 @@ class CosmosConversationClient():
         if message:
             message['feedback'] = feedback
             resp = await self.container_client.upsert_item(message)
+            self._invalidate_messages(user_id, message.get('conversationId'))
             return resp
         else:
             return False
 
+    @timed("cosmos_get_messages")
     async def get_messages(self, user_id, conversation_id):
+        if self.message_cache:
+            cached_messages = self.message_cache.get((user_id, conversation_id))
+            if cached_messages is not None:
+                return list(cached_messages)
+
         parameters = [
             {
                 'name': '@conversationId',
@@ -179,34 +409,7 @@ class CosmosConversationClient():
         async for item in self.container_client.query_items(query=query, parameters=parameters):
             messages.append(item)
 
+        if self.message_cache:
+            self.message_cache.set((user_id, conversation_id), list(messages))
         return messages
 
-
-    def init_cosmosdb_client():
-        cosmos_conversation_client = None
-        if app_settings.chat_history:
-            try:
-                cosmos_endpoint = (
-                    f"https://{app_settings.chat_history.account}.documents.azure.com:443/"
-                )
-
-                if not app_settings.chat_history.account_key:
-                    credential = DefaultAzureCredential()
-                else:
-                    credential = app_settings.chat_history.account_key
-
-                cosmos_conversation_client = CosmosConversationClient(
-                    cosmosdb_endpoint=cosmos_endpoint,
-                    credential=credential,
-                    database_name=app_settings.chat_history.database,
-                    container_name=app_settings.chat_history.conversations_container,
-                    enable_message_feedback=app_settings.chat_history.enable_feedback,
-                )
-            except Exception as e:
-                logging.exception("Exception in CosmosDB initialization", e)
-                cosmos_conversation_client = None
-                raise e
-        else:
-            logging.debug("CosmosDB not configured")
-
-        return cosmos_conversation_client
\ No newline at end of file
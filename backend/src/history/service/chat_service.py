@@ -18,8 +18,8 @@ class ChatService:
     async def delete_messages(self, conversation_id, user_id):
         return await self.repository.delete_messages(conversation_id, user_id)
 
-    async def get_conversations(self, user_id, limit, sort_order='DESC', offset=0):
-        return await self.repository.get_conversations(user_id, limit, sort_order, offset)
+    async def get_conversations_page(self, user_id, limit, sort_order='DESC', continuation_token=None):
+        return await self.repository.get_conversations_page(user_id, limit, sort_order, continuation_token)
 
     async def get_conversation(self, user_id, conversation_id):
         return await self.repository.get_conversation(user_id, conversation_id)
@@ -0,0 +1,143 @@
+import time
+import contextvars
+from bisect import bisect_left
+from functools import wraps
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        index = bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+
+
+class StageMetrics:
+    """
+    Latency histograms of the stages of a chat request (JSON parsing, ACL
+    lookup, Cosmos calls, upstream time to first token, ...), rendered in the
+    Prometheus text format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms[stage] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def render(self, **labels):
+        name = "chat_stage_duration_seconds"
+        lines = [
+            f"# HELP {name} Duration of the stages of chat requests.",
+            f"# TYPE {name} histogram"
+        ]
+        for stage, histogram in sorted(self._histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(stage=stage, **labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(stage=stage, **labels, le="+Inf")} {histogram.count}')
+            lines.append(f'{name}_sum{format_labels(stage=stage, **labels)} {histogram.sum}')
+            lines.append(f'{name}_count{format_labels(stage=stage, **labels)} {histogram.count}')
+        return lines
+
+
+class RequestTimings:
+    """
+    Stage durations of the current request, observed into the shared
+    histograms as they are recorded and reported in the Server-Timing header.
+    """
+
+    def __init__(self, metrics: StageMetrics):
+        self.metrics = metrics
+        self.started_at = time.perf_counter()
+        self.stages = {}
+
+    def record(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.metrics.observe(stage, seconds)
+
+    def record_since_start(self, stage: str):
+        self.record(stage, time.perf_counter() - self.started_at)
+
+    def server_timing(self) -> str:
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started_at) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+def start_request_timings(metrics: StageMetrics) -> RequestTimings:
+    timings = RequestTimings(metrics)
+    _request_timings.set(timings)
+    return timings
+
+
+def current_timings():
+    # None unless instrumentation is enabled for the running request
+    return _request_timings.get()
+
+
+class span:
+    """
+    Times the enclosed block as `stage` of the current request. A context
+    variable lookup is all it costs when instrumentation is disabled.
+    """
+
+    __slots__ = ("stage", "timings", "started_at")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.timings = _request_timings.get()
+
+    def __enter__(self):
+        if self.timings is not None:
+            self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings.record(self.stage, time.perf_counter() - self.started_at)
+
+
+def timed(stage: str):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_labels(**labels) -> str:
+    # e.g. {stage="lookup",worker="42"}; empty without labels
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def render_stats(name: str, stats: dict, labels: str = ""):
+    # Exports a component's stats() as gauges, e.g. chat_title_cache_hits
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            lines.append(f"chat_{name}_{key}{labels} {value}")
+    return lines
@@ -0,0 +1,159 @@
+import time
+import logging
+
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    RateLimitError,
+)
+
+# Seconds a backend is skipped after a 429 without a retry-after header
+DEFAULT_THROTTLE_COOLDOWN = 10.0
+# Seconds a backend is skipped after a connection error or a 5xx response
+FAILURE_COOLDOWN = 5.0
+
+
+class NoBackendAvailableError(Exception):
+    """
+    Raised when every Azure OpenAI backend is throttled or failing.
+    """
+
+    status_code = 429
+
+    def __init__(self, retry_after: float):
+        super().__init__(
+            f"All Azure OpenAI deployments are busy. Retry in {retry_after:.0f} seconds."
+        )
+        self.retry_after = retry_after
+
+
+def retry_after_seconds(error: RateLimitError) -> float:
+    headers = error.response.headers if error.response is not None else {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return DEFAULT_THROTTLE_COOLDOWN
+
+
+class OpenAIBackend:
+    """
+    One Azure OpenAI deployment: its client, deployment name, routing weight
+    and health.
+    """
+
+    def __init__(self, client, model: str, weight: int = 1, name: str = None):
+        self.client = client
+        self.model = model
+        self.weight = max(weight, 1)
+        self.name = name or model
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.cooldown_until <= now
+
+    async def hold(self, stream):
+        # Count a streamed response as outstanding until it is fully read or closed
+        self.in_flight += 1
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            self.in_flight -= 1
+            close = getattr(stream, "close", None)
+            if close:
+                await close()
+
+
+class OpenAIBackendPool:
+    """
+    Routes calls to the available backend with the fewest outstanding
+    requests per unit of weight, failing over to the next backend when one
+    is throttled (429) or failing, and skipping it until its retry-after
+    cool-down has passed.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+
+    def _select(self, attempted):
+        now = time.monotonic()
+        candidates = [
+            backend for backend in self.backends
+            if backend not in attempted and backend.available(now)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: (backend.in_flight + 1) / backend.weight)
+
+    def _others_available(self, backend):
+        now = time.monotonic()
+        return any(other is not backend and other.available(now) for other in self.backends)
+
+    async def call(self, operation):
+        """
+        Await operation(backend) on the selected backend and return
+        (backend, result).
+        """
+        attempted = set()
+        last_error = None
+        while True:
+            backend = self._select(attempted)
+            if backend is None:
+                if last_error:
+                    raise last_error
+                retry_after = min(b.cooldown_until for b in self.backends) - time.monotonic()
+                raise NoBackendAvailableError(max(retry_after, 0))
+
+            attempted.add(backend)
+            backend.in_flight += 1
+            backend.requests += 1
+            try:
+                return backend, await operation(backend)
+            except RateLimitError as e:
+                backend.throttled += 1
+                if len(self.backends) == 1:
+                    # Nothing to fail over to; the client's own retries already ran
+                    raise
+                cooldown = retry_after_seconds(e)
+                logging.warning(f"Azure OpenAI backend {backend.name} throttled for {cooldown}s")
+                backend.cooldown_until = time.monotonic() + cooldown
+                last_error = e
+            except (APIConnectionError, APIStatusError) as e:
+                if isinstance(e, APIStatusError) and e.status_code < 500:
+                    raise
+                logging.warning(f"Azure OpenAI backend {backend.name} failed: {e}")
+                backend.failures += 1
+                if not self._others_available(backend):
+                    # Benching the last healthy backend would fail every
+                    # request until the cool-down ends
+                    raise
+                backend.cooldown_until = time.monotonic() + FAILURE_COOLDOWN
+                last_error = e
+            finally:
+                backend.in_flight -= 1
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.client.close()
+
+    def stats(self):
+        now = time.monotonic()
+        return [
+            {
+                'name': backend.name,
+                'in_flight': backend.in_flight,
+                'requests': backend.requests,
+                'throttled': backend.throttled,
+                'failures': backend.failures,
+                'available': backend.available(now)
+            }
+            for backend in self.backends
+        ]
@@ -0,0 +1,125 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised instead of queueing a request whose wait would exceed the deadline.
+    """
+
+    status_code = 429
+
+    def __init__(self, retry_after: float, queue_position: int):
+        super().__init__(
+            f"The service is busy; {queue_position - 1} requests are ahead of yours. "
+            f"Retry in {retry_after:.0f} seconds."
+        )
+        self.retry_after = retry_after
+        self.queue_position = queue_position
+
+
+class TokenRateGovernor:
+    """
+    Token bucket that admits Azure OpenAI requests at up to `tokens_per_minute`
+    estimated tokens. When the bucket is empty, requests wait in per-user
+    queues that are served round-robin, so one user's burst does not delay
+    everyone else; requests that would wait longer than `max_wait` seconds
+    are rejected immediately.
+    """
+
+    def __init__(self, tokens_per_minute: int, max_wait: float = 10.0):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self.max_wait = max_wait
+        self.tokens = float(tokens_per_minute)
+        self.updated_at = time.monotonic()
+        self.admitted = 0
+        self.rejected = 0
+        self._queues = OrderedDict()
+        self._dispatcher = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    @property
+    def waiting(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _tokens_ahead(self, user_id):
+        # Tokens served before a new request of user_id under round-robin:
+        # every user's waiters up to one round past user_id's own waiters
+        rounds = len(self._queues.get(user_id, ())) + 1
+        tokens = 0
+        position = 0
+        for queue_user_id, queue in self._queues.items():
+            served = list(queue)[:rounds if queue_user_id != user_id else rounds - 1]
+            tokens += sum(cost for cost, _ in served)
+            position += len(served)
+        return tokens, position
+
+    async def acquire(self, user_id, cost: int):
+        cost = min(cost, self.capacity)
+        self._refill()
+        if not self._queues and self.tokens >= cost:
+            self.tokens -= cost
+            self.admitted += 1
+            return
+
+        tokens_ahead, position = self._tokens_ahead(user_id)
+        wait = (tokens_ahead + cost - self.tokens) / self.rate
+        if wait > self.max_wait:
+            self.rejected += 1
+            raise RateLimitExceeded(wait, position + 1)
+
+        admitted = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append((cost, admitted))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await admitted
+
+    def release(self, cost: int):
+        # Give back the tokens of an admitted request that never reached Azure OpenAI
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + min(cost, self.capacity))
+
+    async def _dispatch(self):
+        try:
+            while self._queues:
+                # Take the head of the next user's queue and rotate that user to the back
+                user_id, queue = next(iter(self._queues.items()))
+                cost, admitted = queue[0]
+                if admitted.done():
+                    # Cancelled while waiting
+                    self._pop(user_id, queue)
+                    continue
+
+                self._refill()
+                if self.tokens < cost:
+                    await asyncio.sleep((cost - self.tokens) / self.rate)
+                    continue
+
+                self.tokens -= cost
+                self.admitted += 1
+                admitted.set_result(None)
+                self._pop(user_id, queue)
+        except Exception:
+            logging.exception("Exception in the rate governor dispatcher")
+
+    def _pop(self, user_id, queue):
+        queue.popleft()
+        del self._queues[user_id]
+        if queue:
+            self._queues[user_id] = queue
+
+    def stats(self):
+        self._refill()
+        return {
+            'tokens': self.tokens,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected
+        }
@@ -0,0 +1,156 @@
+import time
+import asyncio
+from collections import deque
+
+
+class QueueTimeoutError(Exception):
+    """
+    Raised when a request waited longer than the queue timeout for a slot.
+    """
+
+    status_code = 429
+
+    def __init__(self, retry_after: float):
+        super().__init__("The service is busy. Please try again shortly.")
+        self.retry_after = retry_after
+
+
+class RequestSlot:
+    def __init__(self, scheduler, user_id):
+        self._scheduler = scheduler
+        self.user_id = user_id
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._scheduler._release(self.user_id)
+
+    def release_when_done(self, task):
+        # Done callbacks run on the event loop however the task ends, even if
+        # a stream from hold() was never iterated and so never ran its finally
+        task.add_done_callback(lambda _: self.release())
+
+    async def hold(self, stream):
+        # Keep the slot until the streamed response is finished or closed
+        try:
+            async for event in stream:
+                yield event
+        finally:
+            self.release()
+            close = getattr(stream, "aclose", None)
+            if close:
+                await close()
+
+
+class FairRequestScheduler:
+    """
+    Admits at most `max_in_flight` concurrent requests per worker and at most
+    `user_max_in_flight` per user. Waiting requests are admitted by weighted
+    fair queueing: the user with the least weighted service so far goes next,
+    so a user with many queued requests cannot starve the others.
+    """
+
+    def __init__(self, max_in_flight: int, user_max_in_flight: int, queue_timeout: float = 30.0, user_weights: dict = None):
+        self.max_in_flight = max_in_flight
+        self.user_max_in_flight = user_max_in_flight
+        self.queue_timeout = queue_timeout
+        self.user_weights = user_weights or {}
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+        self._user_in_flight = {}
+        self._queues = {}
+        self._virtual_time = {}
+        self._virtual_clock = 0.0
+
+    @property
+    def waiting(self):
+        return sum(
+            1 for queue in self._queues.values() for waiter, _ in queue if not waiter.done()
+        )
+
+    def _can_admit(self, user_id):
+        return (
+            self.in_flight < self.max_in_flight and
+            self._user_in_flight.get(user_id, 0) < self.user_max_in_flight
+        )
+
+    def _admit(self, user_id, queue_time=0.0):
+        # Advance the user's virtual finish time by 1 / weight
+        start = max(self._virtual_time.get(user_id, 0.0), self._virtual_clock)
+        self._virtual_clock = start
+        self._virtual_time[user_id] = start + 1.0 / self.user_weights.get(user_id, 1.0)
+
+        self.in_flight += 1
+        self._user_in_flight[user_id] = self._user_in_flight.get(user_id, 0) + 1
+        self.admitted += 1
+        self.total_queue_time += queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+        return RequestSlot(self, user_id)
+
+    async def acquire(self, user_id) -> RequestSlot:
+        if self._can_admit(user_id) and not self._queues.get(user_id):
+            return self._admit(user_id)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append((waiter, time.monotonic()))
+        try:
+            return await asyncio.wait_for(waiter, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise QueueTimeoutError(retry_after=self.queue_timeout)
+        except asyncio.CancelledError:
+            # Admitted just as the request was abandoned
+            if waiter.done() and not waiter.cancelled():
+                waiter.result().release()
+            raise
+
+    def _release(self, user_id):
+        self.in_flight -= 1
+        self._user_in_flight[user_id] -= 1
+        if not self._user_in_flight[user_id]:
+            del self._user_in_flight[user_id]
+        self._dispatch()
+        self._prune(user_id)
+
+    def _prune(self, user_id):
+        # Like a deficit reset in round robin: a user with nothing in flight or
+        # queued rejoins as a new user, so only active users are tracked
+        if user_id not in self._user_in_flight and user_id not in self._queues:
+            self._virtual_time.pop(user_id, None)
+            if not self._virtual_time:
+                self._virtual_clock = 0.0
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight:
+            candidates = []
+            for user_id, queue in list(self._queues.items()):
+                while queue and queue[0][0].done():
+                    # Timed out or cancelled while waiting
+                    queue.popleft()
+                if not queue:
+                    del self._queues[user_id]
+                elif self._can_admit(user_id):
+                    candidates.append(user_id)
+            if not candidates:
+                return
+
+            user_id = min(
+                candidates,
+                key=lambda u: max(self._virtual_time.get(u, 0.0), self._virtual_clock)
+            )
+            waiter, queued_at = self._queues[user_id].popleft()
+            waiter.set_result(self._admit(user_id, time.monotonic() - queued_at))
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'total_queue_time': self.total_queue_time,
+            'max_queue_time': self.max_queue_time
+        }
@@ -0,0 +1,100 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+import numpy
+
+
+def normalize_vector(vector):
+    vector = numpy.asarray(vector, dtype=numpy.float32)
+    norm = numpy.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticCache:
+    """
+    In-process index of recent question embeddings and their answers. Entries
+    are grouped in partitions (one per ACL filter and model configuration) so
+    an answer is only served to requests that could have produced it.
+
+    The normalized embeddings live in one preallocated matrix, so a lookup is
+    a single matrix-vector product. get() and set() are thread-safe, letting
+    the app score in a worker thread instead of on the event loop.
+    """
+
+    def __init__(self, max_entries: int = 1000, threshold: float = 0.95, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._vectors = None
+        self._created_at = [0.0] * max_entries
+        self._values = [None] * max_entries
+        self._free = list(range(max_entries - 1, -1, -1))
+        # Row numbers of each partition, oldest first
+        self._partitions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, partition_key, embedding):
+        with self._lock:
+            rows = self._partitions.get(partition_key)
+            if rows:
+                self._expire(partition_key, rows)
+            if not rows or len(embedding) != self._vectors.shape[1]:
+                self.misses += 1
+                return None
+
+            index = numpy.fromiter(rows, dtype=numpy.intp, count=len(rows))
+            scores = self._vectors[index] @ normalize_vector(embedding)
+            best = int(scores.argmax())
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self._partitions.move_to_end(partition_key)
+            self.hits += 1
+            return self._values[index[best]]
+
+    def set(self, partition_key, embedding, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = numpy.zeros((self.max_entries, len(embedding)), dtype=numpy.float32)
+            elif len(embedding) != self._vectors.shape[1]:
+                return
+
+            if not self._free:
+                # Evict the oldest entry of the least recently used partition
+                oldest_key, oldest_rows = next(iter(self._partitions.items()))
+                self._release(oldest_rows.popleft())
+                if not oldest_rows:
+                    del self._partitions[oldest_key]
+
+            row = self._free.pop()
+            self._vectors[row] = normalize_vector(embedding)
+            self._created_at[row] = time.monotonic()
+            self._values[row] = value
+            self._partitions.setdefault(partition_key, deque()).append(row)
+            self._partitions.move_to_end(partition_key)
+
+    def _release(self, row):
+        self._values[row] = None
+        self._free.append(row)
+
+    def _expire(self, partition_key, rows):
+        now = time.monotonic()
+        while rows and now - self._created_at[rows[0]] > self.ttl:
+            self._release(rows.popleft())
+        if not rows:
+            del self._partitions[partition_key]
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': self.max_entries - len(self._free),
+            'partitions': len(self._partitions)
+        }
+
@@ -16,7 +16,7 @@ from pydantic import (
 )
 from pydantic.alias_generators import to_snake
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import List, Literal, Optional
+from typing import Dict, List, Literal, Optional
 from typing_extensions import Self
 from quart import Request
 from backend.utils import parse_multi_columns, generateFilterString
@@ -67,6 +67,13 @@ class _ChatHistorySettings(BaseSettings):
     account_key: Optional[str] = None
     conversations_container: str
     enable_feedback: bool = False
+    bulk_delete_concurrency: int = 4
+    list_cache_size: int = 0
+    list_cache_ttl: float = 30.0
+    message_cache_size: int = 0
+    message_cache_ttl: float = 60.0
+    save_partial_answers: bool = False
+    server_side_context: bool = False
 
 
 class _PromptflowSettings(BaseSettings):
@@ -83,6 +90,11 @@ class _PromptflowSettings(BaseSettings):
     request_field_name: str = "query"
     response_field_name: str = "reply"
     citations_field_name: str = "documents"
+    stream: bool = False
+    max_concurrency: int = 20
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    http2: bool = True
 
 
 class _AzureOpenAIFunction(BaseModel):
@@ -96,6 +108,14 @@ class _AzureOpenAITool(BaseModel):
     function: _AzureOpenAIFunction
     
 
+class _AzureOpenAIBackend(BaseModel):
+    endpoint: str = Field(..., min_length=1)
+    model: str = Field(..., min_length=1)
+    key: Optional[str] = None
+    weight: conint(ge=1) = 1
+    name: Optional[str] = None
+
+
 class _AzureOpenAISettings(BaseSettings):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_OPENAI_",
@@ -129,6 +149,41 @@ class _AzureOpenAISettings(BaseSettings):
     embedding_key: Optional[str] = None
     embedding_name: Optional[str] = None
     
+    # Deployments to balance chat completions across (JSON list); defaults to endpoint/model
+    backends: Optional[List[_AzureOpenAIBackend]] = None
+    
+    # Client-side token-per-minute governor (0 disables)
+    tokens_per_minute: int = 0
+    rate_limit_max_wait: float = 10.0
+    
+    # Connection pool tuning for the shared client
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    
+    # Merge streamed deltas for up to this many milliseconds (0 disables)
+    stream_coalesce_window_ms: int = 0
+    stream_coalesce_max_bytes: int = 1024
+    
+    # Conversation history sent to the model (history_max_tokens 0 disables)
+    history_max_tokens: int = 0
+    history_summary: bool = False
+    history_summary_max_tokens: int = 256
+    
+    # Exact response cache (size 0 disables)
+    response_cache_size: int = 0
+    response_cache_ttl: float = 3600.0
+    response_cache_allow_sampling: bool = False
+    
+    # Embedding-similarity cache for paraphrased opening questions (size 0 disables)
+    semantic_cache_size: int = 0
+    semantic_cache_threshold: float = 0.95
+    semantic_cache_ttl: float = 3600.0
+    
+    # Conversation title generation
+    title_max_input_tokens: int = 256
+    title_cache_size: int = 1000
+    
     @field_validator('tools', mode='before')
     @classmethod
     def deserialize_tools(cls, tools_json_str: str) -> List[_AzureOpenAITool]:
@@ -221,18 +276,43 @@ class _SearchCommonSettings(BaseSettings):
 
 class DatasourcePayloadConstructor(BaseModel, ABC):
     _settings: '_AppSettings' = PrivateAttr()
+    _payload: Optional[dict] = PrivateAttr(default=None)
     
     def __init__(self, settings: '_AppSettings', **data):
         super().__init__(**data)
         self._settings = settings
     
     @abstractmethod
+    def _construct_parameters(self) -> dict:
+        pass
+    
     def construct_payload_configuration(
         self,
         *args,
         **kwargs
     ):
-        pass
+        # The settings do not change after startup, so the payload is built
+        # once and only the per-request filter is merged in
+        payload = self._payload
+        if payload is None:
+            payload = self._payload = {
+                "type": self._type,
+                "parameters": self._construct_parameters()
+            }
+        
+        # The cached payload is shared and read-only: only the two levels the
+        # filter is merged into are copied
+        filter_string = kwargs.get('filter')
+        if filter_string:
+            payload = {
+                **payload,
+                "parameters": {**payload["parameters"], "filter": filter_string}
+            }
+        
+        return payload
+
+    async def construct_filter_string(self, request: Request) -> Optional[str]:
+        return None
 
 
 class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
@@ -267,6 +347,7 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
         'vectorSemanticHybrid'
     ] = "simple"
     permitted_groups_column: Optional[str] = Field(default=None, exclude=True)
+    permitted_groups_cache_ttl: float = Field(default=300.0, exclude=True)
     
     # Constructed fields
     endpoint: Optional[str] = None
@@ -312,7 +393,7 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
     def set_query_type(self) -> Self:
         self.query_type = to_snake(self.query_type)
 
-    def _set_filter_string(self, request: Request) -> str:
+    async def construct_filter_string(self, request: Request) -> Optional[str]:
         if self.permitted_groups_column:
             user_token = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
             logging.debug(f"USER TOKEN is {'present' if user_token else 'not present'}")
@@ -321,30 +402,19 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
                     "Document-level access control is enabled, but user access token could not be fetched."
                 )
 
-            filter_string = generateFilterString(user_token)
+            filter_string = await generateFilterString(user_token)
             logging.debug(f"FILTER: {filter_string}")
             return filter_string
         
         return None
             
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
-        request = kwargs.pop('request', None)
-        if request and self.permitted_groups_column:
-            self.filter = self._set_filter_string(request)
-            
+    def _construct_parameters(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
-        return {
-            "type": self._type,
-            "parameters": parameters
-        }
+        return parameters
 
 
 class _AzureCosmosDbMongoVcoreSettings(
@@ -404,19 +474,12 @@ class _AzureCosmosDbMongoVcoreSettings(
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _construct_parameters(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
-        return {
-            "type": self._type,
-            "parameters": parameters
-        }
+        return parameters
 
 
 class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
@@ -474,11 +537,7 @@ class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _construct_parameters(self) -> dict:
         self.embedding_dependency = \
             {"type": "model_id", "model_id": self.embedding_model_id} if self.embedding_model_id else \
             self._settings.azure_openai.extract_embedding_dependency() 
@@ -486,10 +545,7 @@ class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
                 
-        return {
-            "type": self._type,
-            "parameters": parameters
-        }
+        return parameters
 
 
 class _PineconeSettings(BaseSettings, DatasourcePayloadConstructor):
@@ -546,20 +602,13 @@ class _PineconeSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _construct_parameters(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
-        return {
-            "type": self._type,
-            "parameters": parameters
-        }
+        return parameters
 
 
 class _AzureMLIndexSettings(BaseSettings, DatasourcePayloadConstructor):
@@ -604,18 +653,11 @@ class _AzureMLIndexSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _construct_parameters(self) -> dict:
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
-        return {
-            "type": self._type,
-            "parameters": parameters
-        }
+        return parameters
 
 
 class _AzureSqlServerSettings(BaseSettings, DatasourcePayloadConstructor):
@@ -642,18 +684,11 @@ class _AzureSqlServerSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def _construct_parameters(self) -> dict:
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         #parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
-        return {
-            "type": self._type,
-            "parameters": parameters
-        }
+        return parameters
     
     
 class _BaseSettings(BaseSettings):
@@ -667,6 +702,15 @@ class _BaseSettings(BaseSettings):
     auth_enabled: bool = False
     sanitize_answer: bool = False
     use_promptflow: bool = False
+    sse_heartbeat_interval: float = 15.0
+    sse_replay_ttl: float = 300.0
+    max_concurrent_requests: int = 0
+    user_max_concurrent_requests: int = 2
+    request_queue_timeout: float = 30.0
+    user_request_weights: Optional[Dict[str, float]] = None
+    metrics_enabled: bool = False
+    metrics_token: Optional[str] = None
+    server_timing_enabled: bool = False
 
 
 class _AppSettings(BaseModel):
@@ -0,0 +1,91 @@
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+
+
+class ReplayStream:
+    """
+    Events of one streamed response, produced by a background task so that the
+    completion keeps running when the client disconnects and can be resumed.
+    """
+
+    def __init__(self, owner_id: str):
+        self.id = uuid.uuid4().hex
+        self.owner_id = owner_id
+        self.events = []
+        self.done = False
+        self.finished_at = None
+        self._condition = asyncio.Condition()
+        self._task = None
+
+    async def _pump(self, source):
+        try:
+            async for event in source:
+                async with self._condition:
+                    self.events.append(event)
+                    self._condition.notify_all()
+        except Exception:
+            logging.exception("Exception while buffering response stream")
+        finally:
+            async with self._condition:
+                self.done = True
+                self.finished_at = time.monotonic()
+                self._condition.notify_all()
+
+    async def follow(self, after: int = -1, heartbeat_interval: float = None):
+        # Yield (index, event) for every event after `after`, waiting for new ones
+        # until the stream is done; yields (None, None) when heartbeat_interval
+        # passes without a new event
+        next_index = after + 1
+        while True:
+            async with self._condition:
+                try:
+                    await asyncio.wait_for(
+                        self._condition.wait_for(lambda: len(self.events) > next_index or self.done),
+                        timeout=heartbeat_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                events = self.events[next_index:]
+                done = self.done
+
+            if not events and not done:
+                yield None, None
+            for event in events:
+                yield next_index, event
+                next_index += 1
+            if done and next_index >= len(self.events):
+                return
+
+
+class StreamReplayBuffer:
+    """
+    Per-worker registry of recent response streams, kept for `ttl` seconds
+    after they finish so a dropped client can resume with Last-Event-ID.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_streams: int = 1000):
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self._streams = OrderedDict()
+
+    def start(self, source, owner_id: str) -> ReplayStream:
+        self._evict()
+        stream = ReplayStream(owner_id)
+        stream._task = asyncio.create_task(stream._pump(source))
+        self._streams[stream.id] = stream
+        return stream
+
+    def get(self, stream_id: str):
+        self._evict()
+        return self._streams.get(stream_id)
+
+    def _evict(self):
+        now = time.monotonic()
+        for stream_id, stream in list(self._streams.items()):
+            if stream.done and now - stream.finished_at > self.ttl:
+                del self._streams[stream_id]
+        while len(self._streams) > self.max_streams:
+            self._streams.popitem(last=False)
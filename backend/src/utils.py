@@ -1,11 +1,28 @@
 import os
 import json
+import time
+import asyncio
+import httpx
+import hashlib
 import logging
-import requests
+import threading
 import dataclasses
 
+from collections import OrderedDict
 from typing import List
 
+from backend.metrics import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
     logging.basicConfig(level=logging.DEBUG)
@@ -22,13 +39,102 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+async def close_stream(stream):
+    # Async generators only run their finally blocks when closed explicitly,
+    # so a disconnected client would otherwise leave the upstream stream open
+    close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+    if close:
+        await close()
+
+
 async def format_as_ndjson(r):
     try:
         async for event in r:
-            yield json.dumps(event, cls=JSONEncoder) + "\n"
+            # Lines from StreamResponseEncoder are already serialized
+            if isinstance(event, str):
+                yield event
+            else:
+                yield json.dumps(event, cls=JSONEncoder) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps({"error": str(error)})
+    finally:
+        await close_stream(r)
+
+
+SECRET_PARAMS = [
+    "key",
+    "connection_string",
+    "embedding_key",
+    "encoded_api_key",
+    "api_key",
+]
+
+# Locations of secrets in a chat completions request body; "*" matches any key or list index
+MODEL_ARGS_SECRET_PATHS = [
+    ("extra_body", "data_sources", "*", "parameters", secret_param)
+    for secret_param in SECRET_PARAMS
+] + [
+    ("extra_body", "data_sources", "*", "parameters", "authentication", secret_param)
+    for secret_param in SECRET_PARAMS
+] + [
+    ("extra_body", "data_sources", "*", "parameters", "embedding_dependency", "authentication", secret_param)
+    for secret_param in SECRET_PARAMS
+]
+
+
+def redact_secrets(obj, secret_paths, mask="*****"):
+    '''
+    Return obj with the values at secret_paths replaced by mask. Only the
+    containers along a matching path are copied; everything else, such as
+    the message history, is shared with the original.
+    '''
+    def redact(node, path):
+        if not path:
+            return mask
+        head, rest = path[0], path[1:]
+        if isinstance(node, dict):
+            keys = list(node.keys()) if head == "*" else [head] if head in node else []
+            if not keys:
+                return node
+            redacted = dict(node)
+            for key in keys:
+                redacted[key] = redact(node[key], rest)
+            return redacted
+        if isinstance(node, list) and head == "*":
+            return [redact(item, rest) for item in node]
+        return node
+
+    for secret_path in secret_paths:
+        obj = redact(obj, secret_path)
+    return obj
+
+
+def log_debug_payload(message, payload, secret_paths=MODEL_ARGS_SECRET_PATHS):
+    # Redaction and serialization only happen when debug logging is enabled
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"{message}: {json.dumps(redact_secrets(payload, secret_paths), indent=4)}")
+
+
+async def format_as_sse(stream, last_event_index=-1, heartbeat_interval=15.0):
+    # Server-Sent Events for a ReplayStream of NDJSON lines; event ids are
+    # "<stream id>:<index>" so a reconnecting client can send Last-Event-ID
+    async for index, event in stream.follow(last_event_index, heartbeat_interval):
+        if index is None:
+            yield ": heartbeat\n\n"
+        else:
+            yield f"id: {stream.id}:{index}\ndata: {event.rstrip()}\n\n"
+    yield "event: end\ndata: {}\n\n"
+
+
+def parse_last_event_id(last_event_id, stream_id) -> int:
+    stream_prefix = f"{stream_id}:"
+    if last_event_id and last_event_id.startswith(stream_prefix):
+        try:
+            return int(last_event_id[len(stream_prefix):])
+        except ValueError:
+            pass
+    return -1
 
 
 def parse_multi_columns(columns: str) -> list:
@@ -38,34 +144,124 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+class LRUCache:
+    """
+    Small in-process LRU cache with an optional per-entry TTL in seconds.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or (self.ttl is not None and time.monotonic() - entry[0] > self.ttl):
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries)
+        }
 
-    headers = {"Authorization": "bearer " + userToken}
-    try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
+
+class UserGroupsFetcher:
+    """
+    Fetches a user's transitive group membership from Microsoft Graph over a
+    pooled connection, caching the result per user token for `ttl` seconds.
+    Concurrent lookups for the same token share one Graph call.
+    """
+
+    endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 1000):
+        self._cache = LRUCache(max_entries, ttl=ttl)
+        self._pending = {}
+        self._http_client = None
+
+    def start(self, ttl: float = None):
+        # Called from the app's before_serving hook and undone by close()
+        if ttl is not None:
+            self._cache.ttl = ttl
+        self._http_client = httpx.AsyncClient(timeout=10.0)
+
+    @timed("acl_lookup")
+    async def fetch(self, userToken):
+        if self._http_client is None:
+            raise RuntimeError("UserGroupsFetcher.start() must be called before fetch()")
+
+        cache_key = hashlib.sha256(userToken.encode("utf-8")).hexdigest()
+        groups = self._cache.get(cache_key)
+        if groups is not None:
+            return groups
+
+        pending = self._pending.get(cache_key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch(userToken, cache_key))
+            self._pending[cache_key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(cache_key, None))
+        # A cancelled request must not cancel the lookup the others are waiting for
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, userToken, cache_key):
+        headers = {"Authorization": "bearer " + userToken}
+        groups = []
+        endpoint = self.endpoint
+        try:
+            # Follow nextLink until every page of group membership is read
+            while endpoint:
+                r = await self._http_client.get(endpoint, headers=headers)
+                if r.status_code != 200:
+                    logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
+                    return []
+
+                r = r.json()
+                groups.extend(r["value"])
+                endpoint = r.get("@odata.nextLink")
+        except Exception as e:
+            logging.error(f"Exception in fetchUserGroups: {e}")
             return []
 
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
+        self._cache.set(cache_key, groups)
+        return groups
 
-        return r["value"]
-    except Exception as e:
-        logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
+    async def close(self):
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+
+user_groups_fetcher = UserGroupsFetcher()
 
 
-def generateFilterString(userToken):
+async def fetchUserGroups(userToken):
+    return await user_groups_fetcher.fetch(userToken)
+
+
+async def generateFilterString(userToken):
     # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
+    userGroups = await fetchUserGroups(userToken)
 
     # Construct filter string
     if not userGroups:
@@ -75,6 +271,216 @@ def generateFilterString(userToken):
     return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
 
 
+class ConcurrencyLimiter:
+    """
+    Bounds the number of concurrent calls to a backend and records how long
+    callers queue for a free slot.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+
+    async def __aenter__(self):
+        queued_at = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        queue_time = time.monotonic() - queued_at
+        self.in_flight += 1
+        self.acquired += 1
+        self.total_queue_time += queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+        if queue_time > 0.1:
+            logging.debug(f"Waited {queue_time:.3f}s for a concurrency slot")
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'acquired': self.acquired,
+            'total_queue_time': self.total_queue_time,
+            'max_queue_time': self.max_queue_time
+        }
+
+
+# Request fields that vary per user or transport and do not change the answer
+RESPONSE_CACHE_IGNORED_ARGS = ("user",)
+
+
+def normalize_text(text):
+    return " ".join(text.split()) if isinstance(text, str) else text
+
+
+def response_cache_key(model_args) -> str:
+    # Hash of everything that determines the answer: messages (including the
+    # system message), sampling parameters and the datasource payload with its
+    # ACL filter
+    key_args = {
+        name: value for name, value in model_args.items()
+        if name not in RESPONSE_CACHE_IGNORED_ARGS
+    }
+    key_args["messages"] = [
+        {"role": message["role"], "content": normalize_text(message["content"])}
+        for message in model_args.get("messages", [])
+    ]
+    serialized = json.dumps(key_args, sort_keys=True, separators=(",", ":"), cls=JSONEncoder)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+async def record_stream(chatCompletionChunks, on_complete):
+    # Pass the chunks through and hand the full list to on_complete only when
+    # the stream finished without error
+    chunks = []
+    try:
+        async for chunk in chatCompletionChunks:
+            chunks.append(chunk)
+            yield chunk
+    finally:
+        await close_stream(chatCompletionChunks)
+    on_complete(chunks)
+
+
+async def time_stream(chatCompletionChunks, timings):
+    # Record the upstream time to first token and, once the stream finished
+    # without error, the time spent streaming the rest
+    first_chunk_at = None
+    try:
+        async for chunk in chatCompletionChunks:
+            if first_chunk_at is None:
+                first_chunk_at = time.perf_counter()
+                timings.record_since_start("time_to_first_token")
+            yield chunk
+    finally:
+        await close_stream(chatCompletionChunks)
+    if first_chunk_at is not None:
+        timings.record("streaming", time.perf_counter() - first_chunk_at)
+
+
+async def replay_stream(chatCompletionChunks):
+    for chunk in chatCompletionChunks:
+        yield chunk
+
+
+_token_encoding = None
+_token_encoding_lock = threading.Lock()
+
+
+def get_token_encoding():
+    # Lazily load the tokenizer; None when tiktoken or its encoding is
+    # unavailable, or while another thread is still loading it
+    global _token_encoding
+    if _token_encoding is None and tiktoken is not None:
+        if not _token_encoding_lock.acquire(blocking=False):
+            return None
+        try:
+            if _token_encoding is None:
+                _token_encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logging.warning(f"Falling back to estimated token counts: {e}")
+            _token_encoding = False
+        finally:
+            _token_encoding_lock.release()
+    return _token_encoding or None
+
+
+# Keyed by a digest of the text so pasted documents are not kept in memory
+_token_counts = LRUCache(4096)
+
+
+def count_tokens(text: str) -> int:
+    cache_key = hashlib.sha256(text.encode("utf-8")).digest()
+    count = _token_counts.get(cache_key)
+    if count is not None:
+        return count
+
+    encoding = get_token_encoding()
+    if not encoding:
+        # Roughly four characters per token for English text; not cached, so
+        # exact counts replace it once the tokenizer is loaded
+        return (len(text) + 3) // 4
+    count = len(encoding.encode(text))
+    _token_counts.set(cache_key, count)
+    return count
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    encoding = get_token_encoding()
+    if encoding:
+        tokens = encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+def message_text(message) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def count_message_tokens(message) -> int:
+    # Content plus the few tokens of per-message framing the chat format adds
+    return count_tokens(message_text(message)) + 4
+
+
+def estimate_request_tokens(model_args) -> int:
+    # Quota a completion can consume: the prompt plus the longest possible answer
+    prompt_tokens = sum(count_message_tokens(m) for m in model_args.get("messages", []))
+    return prompt_tokens + (model_args.get("max_tokens") or 0)
+
+
+def window_messages(messages, max_tokens: int):
+    """
+    Split `messages` into (system, older, recent): the leading system messages,
+    the older turns that do not fit, and the most recent turns that fit within
+    `max_tokens` together with the system messages. The last message is always
+    kept.
+    """
+    system_count = 0
+    while system_count < len(messages) and messages[system_count]["role"] == "system":
+        system_count += 1
+    system = messages[:system_count]
+    history = messages[system_count:]
+
+    budget = max_tokens - sum(count_message_tokens(m) for m in system)
+    start = len(history)
+    while start > 0:
+        tokens = count_message_tokens(history[start - 1])
+        if tokens > budget and start < len(history):
+            break
+        budget -= tokens
+        start -= 1
+
+    # Do not open the window on an orphaned assistant reply
+    while start < len(history) - 1 and history[start]["role"] != "user":
+        start += 1
+
+    return system, history[:start], history[start:]
+
+
+def build_title_input(conversation_messages, max_tokens: int) -> str:
+    # The opening user turn decides the title; later turns and long pastes are cut
+    user_messages = [m for m in conversation_messages if m.get("role") == "user"]
+    first_message = user_messages[0] if user_messages else conversation_messages[-1]
+    return truncate_to_tokens(message_text(first_message).strip(), max_tokens)
+
+
 def format_non_streaming_response(chatCompletion, history_metadata, apim_request_id):
     response_obj = {
         "id": chatCompletion.id,
@@ -106,6 +512,88 @@ def format_non_streaming_response(chatCompletion, history_metadata, apim_request
 
     return {}
 
+def format_stream_message(delta):
+    if hasattr(delta, "context"):
+        return {"role": "tool", "content": json.dumps(delta.context)}
+    if delta.content:
+        return {"role": "assistant", "content": delta.content}
+    return None
+
+
+def format_stream_chunk_message(chatCompletionChunk):
+    if len(chatCompletionChunk.choices) > 0:
+        delta = chatCompletionChunk.choices[0].delta
+        if delta:
+            return format_stream_message(delta)
+    return None
+
+
+async def coalesce_stream(chatCompletionChunks, window_ms: int, max_bytes: int):
+    '''
+    Merge consecutive assistant deltas of a chat completion stream and yield
+    (chunk, message) pairs, flushing once window_ms has passed since the first
+    buffered delta or max_bytes of content is buffered. Tool messages are
+    yielded immediately; chunks without a message are dropped.
+    '''
+    loop = asyncio.get_running_loop()
+    iterator = chatCompletionChunks.__aiter__()
+    window = window_ms / 1000
+    pending_chunk = None
+    pending_content = []
+    pending_bytes = 0
+    deadline = None
+    next_chunk = None
+
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+
+            if done:
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    next_chunk = None
+
+                messageObj = format_stream_chunk_message(chunk)
+                if not messageObj:
+                    continue
+                if messageObj["role"] == "assistant":
+                    if pending_chunk is None:
+                        pending_chunk = chunk
+                        deadline = loop.time() + window
+                    pending_content.append(messageObj["content"])
+                    pending_bytes += len(messageObj["content"].encode("utf-8"))
+                    if pending_bytes < max_bytes and loop.time() < deadline:
+                        continue
+                elif pending_chunk is None:
+                    yield chunk, messageObj
+                    continue
+                else:
+                    # flush buffered content first so tool messages keep their order
+                    yield pending_chunk, {"role": "assistant", "content": "".join(pending_content)}
+                    pending_chunk, pending_content, pending_bytes, deadline = None, [], 0, None
+                    yield chunk, messageObj
+                    continue
+
+            if pending_chunk is not None:
+                yield pending_chunk, {"role": "assistant", "content": "".join(pending_content)}
+                pending_chunk, pending_content, pending_bytes, deadline = None, [], 0, None
+
+        if pending_chunk is not None:
+            yield pending_chunk, {"role": "assistant", "content": "".join(pending_content)}
+    finally:
+        if next_chunk is not None:
+            next_chunk.cancel()
+            # The source cannot be closed while a read is still running
+            await asyncio.wait({next_chunk})
+        await close_stream(chatCompletionChunks)
+
+
 def format_stream_response(chatCompletionChunk, history_metadata, apim_request_id):
     response_obj = {
         "id": chatCompletionChunk.id,
@@ -120,29 +608,58 @@ def format_stream_response(chatCompletionChunk, history_metadata, apim_request_i
     if len(chatCompletionChunk.choices) > 0:
         delta = chatCompletionChunk.choices[0].delta
         if delta:
-            if hasattr(delta, "context"):
-                messageObj = {"role": "tool", "content": json.dumps(delta.context)}
+            messageObj = format_stream_message(delta)
+            if messageObj:
                 response_obj["choices"][0]["messages"].append(messageObj)
                 return response_obj
-            if delta.role == "assistant" and hasattr(delta, "context"):
-                messageObj = {
-                    "role": "assistant",
-                    "context": delta.context,
-                }
-                response_obj["choices"][0]["messages"].append(messageObj)
-                return response_obj
-            else:
-                if delta.content:
-                    messageObj = {
-                        "role": "assistant",
-                        "content": delta.content,
-                    }
-                    response_obj["choices"][0]["messages"].append(messageObj)
-                    return response_obj
 
     return {}
 
 
+class StreamResponseEncoder:
+    """
+    Serializes the chunks of one streamed response into NDJSON lines equal to
+    format_as_ndjson(format_stream_response(...)). The envelope shared by every
+    chunk is serialized once and only the delta message is encoded per chunk,
+    with orjson when it is installed.
+    """
+
+    def __init__(self, history_metadata, apim_request_id):
+        self._suffix = "]}], " + json.dumps(
+            {"history_metadata": history_metadata, "apim-request-id": apim_request_id},
+            cls=JSONEncoder
+        )[1:] + "\n"
+        self._envelope_key = None
+        self._prefix = None
+
+    def encode(self, chatCompletionChunk, messageObj=None) -> str:
+        if messageObj is None:
+            messageObj = format_stream_chunk_message(chatCompletionChunk)
+        if not messageObj:
+            return "{}\n"
+
+        envelope_key = (
+            chatCompletionChunk.id,
+            chatCompletionChunk.model,
+            chatCompletionChunk.created,
+            chatCompletionChunk.object,
+        )
+        if envelope_key != self._envelope_key:
+            self._envelope_key = envelope_key
+            self._prefix = json.dumps({
+                "id": chatCompletionChunk.id,
+                "model": chatCompletionChunk.model,
+                "created": chatCompletionChunk.created,
+                "object": chatCompletionChunk.object,
+            })[:-1] + ', "choices": [{"messages": ['
+
+        if orjson:
+            message = orjson.dumps(messageObj).decode("utf-8")
+        else:
+            message = json.dumps(messageObj)
+        return self._prefix + message + self._suffix
+
+
 def format_pf_non_streaming_response(
     chatCompletion, history_metadata, response_field_name, citations_field_name, message_uuid=None
 ):
@@ -188,6 +705,46 @@ def format_pf_non_streaming_response(
         return {}
 
 
+def format_pf_stream_response(
+    pfChunk, history_metadata, response_field_name, citations_field_name, message_uuid=None
+):
+    if "error" in pfChunk:
+        logging.error(f"Error in promptflow stream: {pfChunk['error']}")
+        return {"error": pfChunk["error"]}
+
+    messages = []
+    if citations_field_name in pfChunk:
+        messages.append({
+            "role": "tool",
+            "content": pfChunk[citations_field_name]
+        })
+    if pfChunk.get(response_field_name):
+        messages.append({
+            "role": "assistant",
+            "content": pfChunk[response_field_name]
+        })
+    if not messages:
+        return {}
+
+    return {
+        "id": message_uuid,
+        "model": "",
+        "created": "",
+        "object": "",
+        "choices": [{"messages": messages}],
+        "history_metadata": history_metadata,
+    }
+
+
+async def parse_sse_data(lines):
+    # Decode the JSON payload of each `data:` line of a Server-Sent Events body
+    async for line in lines:
+        if line.startswith("data:"):
+            data = line[len("data:"):].strip()
+            if data:
+                yield json.loads(data)
+
+
 def convert_to_pf_format(input_json, request_field_name, response_field_name):
     output_json = []
     logging.debug(f"Input json: {input_json}")
@@ -1,6 +1,14 @@
 import { chatHistorySampleData } from '../constants/chatHistory'
 
-import { ChatMessage, Conversation, ConversationRequest, CosmosDBHealth, CosmosDBStatus, UserInfo } from './models'
+import {
+  ChatMessage,
+  Conversation,
+  ConversationPage,
+  ConversationRequest,
+  CosmosDBHealth,
+  CosmosDBStatus,
+  UserInfo
+} from './models'
 
 export async function conversationApi(options: ConversationRequest, abortSignal: AbortSignal): Promise<Response> {
   const response = await fetch('/conversation', {
@@ -35,8 +43,11 @@ export const fetchChatHistoryInit = (): Conversation[] | null => {
   return chatHistorySampleData
 }
 
-export const historyList = async (offset = 0): Promise<Conversation[] | null> => {
-  const response = await fetch(`/history/list?offset=${offset}`, {
+export const historyList = async (continuationToken: string | null = null): Promise<ConversationPage | null> => {
+  const url = continuationToken
+    ? `/history/list?continuation_token=${encodeURIComponent(continuationToken)}`
+    : '/history/list'
+  const response = await fetch(url, {
     method: 'GET'
   })
     .then(async res => {
@@ -65,7 +76,10 @@ export const historyList = async (offset = 0): Promise<Conversation[] | null> =>
           return conversation
         })
       )
-      return conversations
+      return {
+        conversations: conversations,
+        continuationToken: res.headers.get('X-Continuation-Token')
+      }
     })
     .catch(_err => {
       console.error('There was an issue fetching your data.')
@@ -115,10 +129,18 @@ export const historyRead = async (convId: string): Promise<ChatMessage[]> => {
 export const historyGenerate = async (
   options: ConversationRequest,
   abortSignal: AbortSignal,
-  convId?: string
+  convId?: string,
+  serverSideContext?: boolean
 ): Promise<Response> => {
   let body
-  if (convId) {
+  if (convId && serverSideContext) {
+    // The server rebuilds the earlier turns from the stored conversation
+    body = JSON.stringify({
+      conversation_id: convId,
+      messages: options.messages.slice(-1),
+      server_side_context: true
+    })
+  } else if (convId) {
     body = JSON.stringify({
       conversation_id: convId,
       messages: options.messages
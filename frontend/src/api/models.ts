@@ -68,6 +68,11 @@ export type Conversation = {
   date: string
 }
 
+export type ConversationPage = {
+  conversations: Conversation[]
+  continuationToken: string | null
+}
+
 export enum ChatCompletionType {
   ChatCompletion = 'chat.completion',
   ChatCompletionChunk = 'chat.completion.chunk'
@@ -145,6 +150,7 @@ export type FrontendSettings = {
   feedback_enabled?: string | null
   ui?: UI
   sanitize_answer?: boolean
+  server_side_context?: boolean
 }
 
 export enum Feedback {
@@ -330,7 +330,12 @@ const Chat = () => {
     var errorResponseMessage = 'Please try again. If the problem persists, please contact the site administrator.'
     try {
       const response = conversationId
-        ? await historyGenerate(request, abortController.signal, conversationId)
+        ? await historyGenerate(
+            request,
+            abortController.signal,
+            conversationId,
+            appStateContext?.state.frontendSettings?.server_side_context
+          )
         : await historyGenerate(request, abortController.signal)
       if (!response?.ok) {
         const responseJson = await response.json()
@@ -380,6 +385,11 @@ const Chat = () => {
               if (obj !== '' && obj !== '{}') {
                 runningText += obj
                 result = JSON.parse(runningText)
+                if (result.history_metadata && !result.choices) {
+                  // Trailing line carrying the generated conversation title
+                  runningText = ''
+                  return
+                }
                 if (!result.choices?.[0]?.messages?.[0].content) {
                   errorResponseMessage = NO_CONTENT_ERROR
                   throw Error()
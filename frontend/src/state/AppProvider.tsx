@@ -24,6 +24,7 @@ export interface AppState {
   chatHistoryLoadingState: ChatHistoryLoadingState
   isCosmosDBAvailable: CosmosDBHealth
   chatHistory: Conversation[] | null
+  chatHistoryContinuationToken: string | null
   filteredChatHistory: Conversation[] | null
   currentChat: Conversation | null
   frontendSettings: FrontendSettings | null
@@ -43,6 +44,7 @@ export type Action =
   | { type: 'DELETE_CHAT_HISTORY' }
   | { type: 'DELETE_CURRENT_CHAT_MESSAGES'; payload: string }
   | { type: 'FETCH_CHAT_HISTORY'; payload: Conversation[] | null }
+  | { type: 'SET_CHAT_HISTORY_CONTINUATION_TOKEN'; payload: string | null }
   | { type: 'FETCH_FRONTEND_SETTINGS'; payload: FrontendSettings | null }
   | {
     type: 'SET_FEEDBACK_STATE'
@@ -54,6 +56,7 @@ const initialState: AppState = {
   isChatHistoryOpen: false,
   chatHistoryLoadingState: ChatHistoryLoadingState.Loading,
   chatHistory: null,
+  chatHistoryContinuationToken: null,
   filteredChatHistory: null,
   currentChat: null,
   isCosmosDBAvailable: {
@@ -82,15 +85,16 @@ export const AppStateProvider: React.FC<AppStateProviderProps> = ({ children })
 
   useEffect(() => {
     // Check for cosmosdb config and fetch initial data here
-    const fetchChatHistory = async (offset = 0): Promise<Conversation[] | null> => {
-      const result = await historyList(offset)
+    const fetchChatHistory = async (): Promise<Conversation[] | null> => {
+      const result = await historyList()
         .then(response => {
           if (response) {
-            dispatch({ type: 'FETCH_CHAT_HISTORY', payload: response })
+            dispatch({ type: 'FETCH_CHAT_HISTORY', payload: response.conversations })
+            dispatch({ type: 'SET_CHAT_HISTORY_CONTINUATION_TOKEN', payload: response.continuationToken })
           } else {
             dispatch({ type: 'FETCH_CHAT_HISTORY', payload: null })
           }
-          return response
+          return response ? response.conversations : null
         })
         .catch(_err => {
           dispatch({ type: 'UPDATE_CHAT_HISTORY_LOADING_STATE', payload: ChatHistoryLoadingState.Fail })
@@ -62,6 +62,8 @@ export const appStateReducer = (state: AppState, action: Action): AppState => {
       }
     case 'FETCH_CHAT_HISTORY':
       return { ...state, chatHistory: action.payload }
+    case 'SET_CHAT_HISTORY_CONTINUATION_TOKEN':
+      return { ...state, chatHistoryContinuationToken: action.payload }
     case 'SET_COSMOSDB_STATUS':
       return { ...state, isCosmosDBAvailable: action.payload }
     case 'FETCH_FRONTEND_SETTINGS':
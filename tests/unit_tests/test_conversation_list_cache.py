@@ -0,0 +1,41 @@
+from backend.history.conversation_list_cache import ConversationListCache
+
+
+def test_conversation_list_cache_hit_and_invalidate():
+    cache = ConversationListCache()
+    assert cache.get("user1") is None
+
+    cache.set("user1", None, [{"id": "c1"}], "token1", cache.generation)
+    assert cache.get("user1") == ([{"id": "c1"}], "token1")
+    assert cache.get("user1", "token1") is None
+
+    cache.invalidate("user1")
+    assert cache.get("user1") is None
+    assert cache.stats() == {"hits": 1, "misses": 3, "users": 0}
+
+
+def test_conversation_list_cache_evicts_least_recently_used():
+    cache = ConversationListCache(max_users=2)
+    cache.set("user1", None, [], None, cache.generation)
+    cache.set("user2", None, [], None, cache.generation)
+    cache.get("user1")
+    cache.set("user3", None, [], None, cache.generation)
+
+    assert cache.get("user2") is None
+    assert cache.get("user1") is not None
+    assert cache.get("user3") is not None
+
+
+def test_conversation_list_cache_expires():
+    cache = ConversationListCache(ttl=-1)
+    cache.set("user1", None, [], None, cache.generation)
+    assert cache.get("user1") is None
+
+
+def test_conversation_list_cache_drops_reads_that_raced_a_write():
+    cache = ConversationListCache()
+    generation = cache.generation
+    # A write lands while the read is still querying Cosmos
+    cache.invalidate("user1")
+    cache.set("user1", None, [{"id": "deleted"}], None, generation)
+    assert cache.get("user1") is None
@@ -0,0 +1,60 @@
+import pytest
+from backend.metrics import (
+    StageMetrics,
+    current_timings,
+    format_labels,
+    render_stats,
+    span,
+    start_request_timings,
+    timed,
+)
+
+
+@pytest.mark.asyncio
+async def test_spans_are_noops_without_request_timings():
+    @timed("lookup")
+    async def lookup():
+        return "groups"
+
+    with span("parse_json"):
+        pass
+    assert await lookup() == "groups"
+    assert current_timings() is None
+
+
+@pytest.mark.asyncio
+async def test_spans_record_request_stages():
+    metrics = StageMetrics(buckets=(0.1, 1.0))
+    timings = start_request_timings(metrics)
+
+    @timed("lookup")
+    async def lookup():
+        return "groups"
+
+    with span("parse_json"):
+        pass
+    await lookup()
+    await lookup()
+    timings.record("streaming", 0.5)
+
+    assert list(timings.stages) == ["parse_json", "lookup", "streaming"]
+    header = timings.server_timing()
+    assert header.startswith("parse_json;dur=")
+    assert "streaming;dur=500.0" in header
+    assert "total;dur=" in header
+
+    lines = metrics.render()
+    assert 'chat_stage_duration_seconds_count{stage="lookup"} 2' in lines
+    assert 'chat_stage_duration_seconds_bucket{stage="streaming",le="0.1"} 0' in lines
+    assert 'chat_stage_duration_seconds_bucket{stage="streaming",le="1.0"} 1' in lines
+    assert 'chat_stage_duration_seconds_bucket{stage="streaming",le="+Inf"} 1' in lines
+    assert 'chat_stage_duration_seconds_count{stage="lookup",worker="42"} 2' in metrics.render(worker=42)
+
+
+def test_render_stats():
+    labels = format_labels(backend="east", worker=42)
+    lines = render_stats("openai_backend", {"name": "east", "in_flight": 2, "available": True}, labels)
+    assert lines == [
+        'chat_openai_backend_in_flight{backend="east",worker="42"} 2',
+        'chat_openai_backend_available{backend="east",worker="42"} 1',
+    ]
@@ -0,0 +1,82 @@
+import httpx
+import pytest
+from openai import InternalServerError, RateLimitError
+from backend.openai_pool import NoBackendAvailableError, OpenAIBackend, OpenAIBackendPool
+
+
+def rate_limit_error(retry_after):
+    response = httpx.Response(
+        429,
+        headers={"retry-after": str(retry_after)},
+        request=httpx.Request("POST", "https://aoai.example/chat/completions"),
+    )
+    return RateLimitError("Too Many Requests", response=response, body=None)
+
+
+@pytest.mark.asyncio
+async def test_pool_fails_over_and_cools_down_throttled_backend():
+    first = OpenAIBackend(None, "first")
+    second = OpenAIBackend(None, "second")
+    pool = OpenAIBackendPool([first, second])
+    calls = []
+
+    async def operation(backend):
+        calls.append(backend.model)
+        if backend is first:
+            raise rate_limit_error(60)
+        return "answer"
+
+    assert await pool.call(operation) == (second, "answer")
+    assert await pool.call(operation) == (second, "answer")
+    assert calls == ["first", "second", "second"]
+    assert first.throttled == 1
+    assert first.in_flight == 0 and second.in_flight == 0
+
+    second.cooldown_until = first.cooldown_until
+    with pytest.raises(NoBackendAvailableError) as exc_info:
+        await pool.call(operation)
+    assert exc_info.value.status_code == 429
+
+
+@pytest.mark.asyncio
+async def test_pool_never_cools_down_its_last_available_backend():
+    response = httpx.Response(500, request=httpx.Request("POST", "https://aoai.example/chat/completions"))
+
+    async def operation(backend):
+        raise InternalServerError("Internal Server Error", response=response, body=None)
+
+    single = OpenAIBackend(None, "single")
+    pool = OpenAIBackendPool([single])
+    with pytest.raises(InternalServerError):
+        await pool.call(operation)
+    with pytest.raises(RateLimitError):
+        await pool.call(_throttled)
+    assert single.cooldown_until == 0.0
+
+    first = OpenAIBackend(None, "first")
+    second = OpenAIBackend(None, "second")
+    pool = OpenAIBackendPool([first, second])
+    with pytest.raises(InternalServerError):
+        await pool.call(operation)
+    # The first failure benches one backend; the other stays in rotation
+    assert [first.cooldown_until > 0, second.cooldown_until > 0].count(True) == 1
+
+
+async def _throttled(backend):
+    raise rate_limit_error(60)
+
+
+@pytest.mark.asyncio
+async def test_pool_routes_by_outstanding_requests_per_weight():
+    light = OpenAIBackend(None, "light")
+    heavy = OpenAIBackend(None, "heavy", weight=3)
+    pool = OpenAIBackendPool([light, heavy])
+    light.in_flight = 1
+    heavy.in_flight = 2
+
+    backend, _ = await pool.call(lambda backend: _result(backend))
+    assert backend is heavy
+
+
+async def _result(backend):
+    return backend.model
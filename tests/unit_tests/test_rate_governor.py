@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+from backend.rate_governor import RateLimitExceeded, TokenRateGovernor
+
+
+@pytest.mark.asyncio
+async def test_governor_serves_users_round_robin():
+    # 6000 tokens per minute refills 100 tokens per second
+    governor = TokenRateGovernor(tokens_per_minute=6000, max_wait=5)
+    await governor.acquire("user1", 6000)
+
+    order = []
+
+    async def request(user_id, name):
+        await governor.acquire(user_id, 5)
+        order.append(name)
+
+    tasks = [
+        asyncio.create_task(request("user1", "a1")),
+        asyncio.create_task(request("user1", "a2")),
+        asyncio.create_task(request("user1", "a3")),
+        asyncio.create_task(request("user2", "b1")),
+    ]
+    await asyncio.gather(*tasks)
+
+    assert order == ["a1", "b1", "a2", "a3"]
+    assert governor.stats()["waiting"] == 0
+
+
+@pytest.mark.asyncio
+async def test_governor_sheds_requests_past_the_deadline():
+    governor = TokenRateGovernor(tokens_per_minute=600, max_wait=1)
+    await governor.acquire("user1", 600)
+
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await governor.acquire("user2", 100)
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.retry_after > 1
+    assert governor.stats()["rejected"] == 1
+
+
+@pytest.mark.asyncio
+async def test_governor_takes_back_released_tokens():
+    governor = TokenRateGovernor(tokens_per_minute=6000, max_wait=1)
+    await governor.acquire("user1", 6000)
+    governor.release(6000)
+
+    # Admitted right away instead of waiting for the bucket to refill
+    await asyncio.wait_for(governor.acquire("user1", 6000), timeout=0.5)
+    assert governor.stats()["admitted"] == 2
@@ -0,0 +1,85 @@
+import asyncio
+import pytest
+from backend.request_scheduler import FairRequestScheduler, QueueTimeoutError
+
+
+@pytest.mark.asyncio
+async def test_scheduler_caps_users_and_admits_fairly():
+    scheduler = FairRequestScheduler(max_in_flight=2, user_max_in_flight=2)
+    first = await scheduler.acquire("heavy")
+    second = await scheduler.acquire("heavy")
+
+    order = []
+
+    async def request(user_id):
+        slot = await scheduler.acquire(user_id)
+        order.append(user_id)
+        return slot
+
+    heavy = asyncio.create_task(request("heavy"))
+    light = asyncio.create_task(request("light"))
+    await asyncio.sleep(0)
+    assert scheduler.stats()["waiting"] == 2
+
+    first.release()
+    (await light).release()
+    second.release()
+    (await heavy).release()
+
+    assert order == ["light", "heavy"]
+    assert scheduler.stats()["in_flight"] == 0
+    assert scheduler.stats()["admitted"] == 4
+
+
+@pytest.mark.asyncio
+async def test_scheduler_rejects_after_queue_timeout():
+    scheduler = FairRequestScheduler(max_in_flight=2, user_max_in_flight=1, queue_timeout=0.01)
+    slot = await scheduler.acquire("user1")
+
+    with pytest.raises(QueueTimeoutError):
+        await scheduler.acquire("user1")
+
+    other = await scheduler.acquire("user2")
+    slot.release()
+    other.release()
+    assert scheduler.stats() == {
+        "in_flight": 0,
+        "waiting": 0,
+        "admitted": 2,
+        "rejected": 1,
+        "total_queue_time": 0.0,
+        "max_queue_time": 0.0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_scheduler_releases_slots_of_streams_that_never_started():
+    scheduler = FairRequestScheduler(max_in_flight=2, user_max_in_flight=1)
+
+    async def answer():
+        yield "token"
+
+    async def serve_request():
+        slot = await scheduler.acquire("user1")
+        stream = slot.hold(answer())
+        slot.release_when_done(asyncio.current_task())
+        return stream
+
+    # The client went away before the response body was read
+    stream = await asyncio.create_task(serve_request())
+    await asyncio.sleep(0)
+    assert scheduler.stats()["in_flight"] == 0
+    (await scheduler.acquire("user1")).release()
+    await stream.aclose()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_forgets_idle_users():
+    scheduler = FairRequestScheduler(max_in_flight=2, user_max_in_flight=1)
+    busy = await scheduler.acquire("busy")
+    for i in range(100):
+        (await scheduler.acquire(f"user{i}")).release()
+    assert list(scheduler._virtual_time) == ["busy"]
+
+    busy.release()
+    assert scheduler._virtual_time == {}
@@ -0,0 +1,26 @@
+from backend.semantic_cache import SemanticCache
+
+
+def test_semantic_cache_matches_similar_questions_within_partition():
+    cache = SemanticCache(threshold=0.9)
+    cache.set("filter-a", [1.0, 0.0, 0.0], "answer")
+
+    assert cache.get("filter-a", [0.95, 0.1, 0.0]) == "answer"
+    assert cache.get("filter-a", [0.0, 1.0, 0.0]) is None
+    assert cache.get("filter-b", [1.0, 0.0, 0.0]) is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "entries": 1, "partitions": 1}
+
+
+def test_semantic_cache_evicts_and_expires():
+    cache = SemanticCache(max_entries=2)
+    cache.set("a", [1.0, 0.0], "first")
+    cache.set("b", [1.0, 0.0], "second")
+    cache.set("b", [0.0, 1.0], "third")
+
+    assert cache.get("a", [1.0, 0.0]) is None
+    assert cache.get("b", [0.0, 1.0]) == "third"
+
+    expiring = SemanticCache(ttl=-1)
+    expiring.set("a", [1.0, 0.0], "answer")
+    assert expiring.get("a", [1.0, 0.0]) is None
+    assert expiring.stats()["entries"] == 0
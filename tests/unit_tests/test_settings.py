@@ -51,6 +51,12 @@ def test_dotenv_with_azure_search_success(app_settings):
     assert payload["parameters"]["endpoint"] == "https://search_service.search.windows.net"
     print(payload)
 
+    # Per-request filters do not end up in the cached payload
+    filtered_payload = app_settings.datasource.construct_payload_configuration(filter="group_ids/any(g:g eq 'a')")
+    assert filtered_payload["parameters"]["filter"] == "group_ids/any(g:g eq 'a')"
+    assert filtered_payload["parameters"]["endpoint"] == "https://search_service.search.windows.net"
+    assert "filter" not in app_settings.datasource.construct_payload_configuration()["parameters"]
+
 
 def test_dotenv_with_elasticsearch_success(app_settings):
     # Validate model object
@@ -0,0 +1,34 @@
+import asyncio
+import pytest
+from backend.stream_replay import StreamReplayBuffer
+from backend.utils import format_as_sse, parse_last_event_id
+
+
+async def slow_source(lines):
+    for line in lines:
+        await asyncio.sleep(0.01)
+        yield line
+
+
+@pytest.mark.asyncio
+async def test_format_as_sse_resumes_after_last_event_id():
+    buffer = StreamReplayBuffer()
+    stream = buffer.start(slow_source(['{"a": 1}\n', '{"a": 2}\n']), "user1")
+
+    events = [event async for event in format_as_sse(stream)]
+    assert events == [
+        f'id: {stream.id}:0\ndata: {{"a": 1}}\n\n',
+        f'id: {stream.id}:1\ndata: {{"a": 2}}\n\n',
+        'event: end\ndata: {}\n\n'
+    ]
+
+    last_event_index = parse_last_event_id(f"{stream.id}:0", stream.id)
+    resumed = [event async for event in format_as_sse(buffer.get(stream.id), last_event_index)]
+    assert resumed == events[1:]
+
+
+def test_parse_last_event_id():
+    assert parse_last_event_id(None, "s1") == -1
+    assert parse_last_event_id("s2:3", "s1") == -1
+    assert parse_last_event_id("s1:x", "s1") == -1
+    assert parse_last_event_id("s1:3", "s1") == 3
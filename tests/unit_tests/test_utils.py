@@ -1,5 +1,31 @@
+import json
+import httpx
+import asyncio
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from openai.types.chat import ChatCompletionChunk
+from backend.metrics import StageMetrics, start_request_timings
+import backend.utils
+from backend.utils import (
+    build_title_input,
+    coalesce_stream,
+    ConcurrencyLimiter,
+    format_as_ndjson,
+    format_pf_stream_response,
+    count_tokens,
+    LRUCache,
+    parse_sse_data,
+    format_stream_response,
+    get_token_encoding,
+    parse_multi_columns,
+    record_stream,
+    redact_secrets,
+    response_cache_key,
+    MODEL_ARGS_SECRET_PATHS,
+    StreamResponseEncoder,
+    time_stream,
+    UserGroupsFetcher,
+    window_messages,
+)
 
 
 @pytest.mark.asyncio
@@ -27,3 +53,254 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+@pytest.mark.asyncio
+async def test_user_groups_fetcher_pages_and_caches():
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(str(request.url))
+        if "page=2" in str(request.url):
+            return httpx.Response(200, json={"value": [{"id": "group2"}]})
+        return httpx.Response(200, json={
+            "value": [{"id": "group1"}],
+            "@odata.nextLink": "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?page=2"
+        })
+
+    fetcher = UserGroupsFetcher()
+    fetcher._http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    # Concurrent first requests share one Graph lookup
+    results = await asyncio.gather(fetcher.fetch("token"), fetcher.fetch("token"))
+    assert results == [[{"id": "group1"}, {"id": "group2"}]] * 2
+    assert await fetcher.fetch("token") == [{"id": "group1"}, {"id": "group2"}]
+    assert len(requests_seen) == 2
+    await fetcher.close()
+
+
+def test_redact_secrets():
+    messages = [{"role": "user", "content": "hello"}]
+    model_args = {
+        "messages": messages,
+        "extra_body": {
+            "data_sources": [
+                {
+                    "type": "azure_search",
+                    "parameters": {
+                        "index_name": "index",
+                        "authentication": {"type": "api_key", "key": "secret"},
+                        "embedding_dependency": {
+                            "type": "endpoint",
+                            "authentication": {"type": "api_key", "api_key": "secret"}
+                        }
+                    }
+                }
+            ]
+        }
+    }
+
+    redacted = redact_secrets(model_args, MODEL_ARGS_SECRET_PATHS)
+    parameters = redacted["extra_body"]["data_sources"][0]["parameters"]
+    assert parameters["authentication"] == {"type": "api_key", "key": "*****"}
+    assert parameters["embedding_dependency"]["authentication"]["api_key"] == "*****"
+    assert parameters["index_name"] == "index"
+    assert "key" not in parameters
+    assert redacted["messages"] is messages
+    assert model_args["extra_body"]["data_sources"][0]["parameters"]["authentication"]["key"] == "secret"
+
+
+def test_stream_response_encoder_matches_format_stream_response():
+    history_metadata = {"conversation_id": "conversation1", "title": "title"}
+    encoder = StreamResponseEncoder(history_metadata, "request1")
+    for delta in [{"role": "assistant", "content": "Hello"}, {"content": " world\n"}, {}]:
+        chunk = ChatCompletionChunk(
+            id="chatcmpl-1",
+            model="gpt-4",
+            created=1,
+            object="chat.completion.chunk",
+            choices=[{"index": 0, "delta": delta, "finish_reason": None}],
+        )
+        line = encoder.encode(chunk)
+        assert line.endswith("\n")
+        assert json.loads(line) == format_stream_response(chunk, history_metadata, "request1")
+
+
+def make_chunk(delta):
+    return ChatCompletionChunk(
+        id="chatcmpl-1",
+        model="gpt-4",
+        created=1,
+        object="chat.completion.chunk",
+        choices=[{"index": 0, "delta": delta, "finish_reason": None}],
+    )
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream():
+    async def dummy_stream():
+        yield make_chunk({"role": "assistant", "content": "Hel"})
+        yield make_chunk({"content": "lo"})
+        yield make_chunk({})
+        await asyncio.sleep(0.1)
+        yield make_chunk({"content": " world"})
+        yield make_chunk({"content": "!" * 10})
+        yield make_chunk({"content": "?"})
+
+    messages = [
+        messageObj["content"]
+        async for _, messageObj in coalesce_stream(dummy_stream(), window_ms=50, max_bytes=8)
+    ]
+    assert messages == ["Hello", " world!!!!!!!!!!", "?"]
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limiter():
+    limiter = ConcurrencyLimiter(max_concurrency=2)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with limiter:
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.05)
+
+    await asyncio.gather(*(call() for _ in range(5)))
+
+    stats = limiter.stats()
+    assert peak == 2
+    assert stats["in_flight"] == 0
+    assert stats["waiting"] == 0
+    assert stats["acquired"] == 5
+    assert stats["max_queue_time"] >= 0.05
+
+
+@pytest.mark.asyncio
+async def test_format_pf_stream_response():
+    async def sse_lines():
+        for line in ['data: {"documents": []}', "", 'data: {"reply": "Hi"}', "", "data: {}", ""]:
+            yield line
+
+    responses = [
+        format_pf_stream_response(pfChunk, {}, "reply", "documents", "m1")
+        async for pfChunk in parse_sse_data(sse_lines())
+    ]
+    assert [r["choices"][0]["messages"] if r else r for r in responses] == [
+        [{"role": "tool", "content": []}],
+        [{"role": "assistant", "content": "Hi"}],
+        {},
+    ]
+    assert responses[1]["id"] == "m1"
+
+
+def test_build_title_input():
+    messages = [
+        {"role": "system", "content": "You are helpful."},
+        {"role": "user", "content": "word " * 1000},
+        {"role": "assistant", "content": "ok"},
+    ]
+    title_input = build_title_input(messages, max_tokens=32)
+    assert title_input.startswith("word word")
+    assert count_tokens(title_input) <= 32
+
+
+def test_lru_cache():
+    cache = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {"hits": 2, "misses": 1, "entries": 2}
+
+    expiring = LRUCache(ttl=-1)
+    expiring.set("a", 1)
+    assert expiring.get("a") is None
+
+
+def test_window_messages():
+    messages = [{"role": "system", "content": "system"}]
+    for i in range(5):
+        messages.append({"role": "user", "content": f"question {i} " + "x" * 100})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "x" * 100})
+    messages.append({"role": "user", "content": "last question"})
+
+    system, older, recent = window_messages(messages, max_tokens=100)
+    assert system == messages[:1]
+    assert older == messages[1:9]
+    assert recent == messages[9:]
+
+    system, older, recent = window_messages(messages, max_tokens=1)
+    assert recent == messages[-1:]
+
+    system, older, recent = window_messages(messages, max_tokens=10000)
+    assert older == []
+
+
+def test_response_cache_key():
+    model_args = {
+        "messages": [{"role": "user", "content": "What is  the VPN address? "}],
+        "temperature": 0,
+        "user": '{"EndUserId": "user1"}',
+        "extra_body": {"data_sources": [{"type": "azure_search", "parameters": {"filter": "a"}}]},
+    }
+    same_question = dict(
+        model_args,
+        messages=[{"role": "user", "content": "What is the VPN address?"}],
+        user='{"EndUserId": "user2"}',
+    )
+    other_filter = dict(
+        model_args,
+        extra_body={"data_sources": [{"type": "azure_search", "parameters": {"filter": "b"}}]},
+    )
+
+    assert response_cache_key(model_args) == response_cache_key(same_question)
+    assert response_cache_key(model_args) != response_cache_key(other_filter)
+    assert response_cache_key(model_args) != response_cache_key(dict(model_args, temperature=1))
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_closes_upstream_on_disconnect():
+    class Upstream:
+        closed = False
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            return {"content": "token"}
+
+        async def close(self):
+            self.closed = True
+
+    upstream = Upstream()
+    completed = []
+    stream = format_as_ndjson(record_stream(upstream, completed.append))
+    assert await stream.__anext__() == '{"content": "token"}\n'
+
+    # What the server does with the response body when the client disconnects
+    await stream.aclose()
+    assert upstream.closed
+    assert completed == []
+
+
+@pytest.mark.asyncio
+async def test_time_stream_records_upstream_stages():
+    async def upstream():
+        yield "first"
+        yield "second"
+
+    timings = start_request_timings(StageMetrics())
+    chunks = [chunk async for chunk in time_stream(upstream(), timings)]
+    assert chunks == ["first", "second"]
+    assert list(timings.stages) == ["time_to_first_token", "streaming"]
+
+
+def test_token_encoding_is_not_awaited_while_loading(monkeypatch):
+    # The startup load timed out and is still running in its thread
+    monkeypatch.setattr(backend.utils, "_token_encoding", None)
+    with backend.utils._token_encoding_lock:
+        assert get_token_encoding() is None
+        assert count_tokens("loading tokenizer") == 5
@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import timeit
+
+from openai.types.chat import ChatCompletionChunk
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.utils import (
+    JSONEncoder,
+    StreamResponseEncoder,
+    format_stream_response,
+)
+
+#compare the per-chunk cost of the streaming NDJSON encoders:
+#  python tools/stream_encoder_benchmark.py [number of chunks]
+
+HISTORY_METADATA = {
+    "conversation_id": "6f2a3c1e-0d7b-4f55-9a63-2b8f0e4c7d11",
+    "title": "Employee handbook benefits",
+    "date": "2024-05-01T12:00:00.000000",
+}
+APIM_REQUEST_ID = "3c7e9a2b-5f1d-4e8a-b6c0-9d2f4a1e7b35"
+
+
+def make_chunk(content):
+    return ChatCompletionChunk(
+        id="chatcmpl-9Qx1b2C3d4E5f6G7h8I9j0K1l2M3",
+        model="gpt-4",
+        created=1714564800,
+        object="chat.completion.chunk",
+        choices=[{"index": 0, "delta": {"role": "assistant", "content": content}, "finish_reason": None}],
+    )
+
+
+def encode_with_dicts(chunks):
+    return [
+        json.dumps(format_stream_response(chunk, HISTORY_METADATA, APIM_REQUEST_ID), cls=JSONEncoder) + "\n"
+        for chunk in chunks
+    ]
+
+
+def encode_with_stream_encoder(chunks):
+    encoder = StreamResponseEncoder(HISTORY_METADATA, APIM_REQUEST_ID)
+    return [encoder.encode(chunk) for chunk in chunks]
+
+
+if __name__ == "__main__":
+    number_of_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    chunks = [make_chunk(f" token{i}") for i in range(number_of_chunks)]
+
+    for line_a, line_b in zip(encode_with_dicts(chunks), encode_with_stream_encoder(chunks)):
+        assert json.loads(line_a) == json.loads(line_b)
+
+    for name, encode in [("dict + JSONEncoder", encode_with_dicts), ("StreamResponseEncoder", encode_with_stream_encoder)]:
+        seconds = min(timeit.repeat(lambda: encode(chunks), number=10, repeat=5)) / 10
+        print(f"{name:<24} {seconds / number_of_chunks * 1e6:8.2f} us/chunk")